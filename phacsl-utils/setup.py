@@ -19,6 +19,11 @@ argparser.add_argument('--no-bitset',
         help='optionally compile utils.collections.cbits extension',
         action='store_false')
 
+argparser.add_argument('--no-csvsplit',
+        dest='with_csvsplit',
+        help='optionally compile utils.formats.csvsplit extension',
+        action='store_false')
+
 args, unknown = argparser.parse_known_args()
 sys.argv = [sys.argv[0]] + unknown
 argparser.print_help()
@@ -70,6 +75,10 @@ if args.with_bitset:
     _ext_modules.extend(
         make_cython_ext('phacsl.utils.collections.cbits', 'src/phacsl/utils/collections/cbits.pyx'))
 
+if args.with_csvsplit:
+    _ext_modules.extend(
+        make_cython_ext('phacsl.utils.formats.csvsplit', 'src/phacsl/utils/formats/csvsplit.pyx'))
+
 setup(name='phacsl-utils',
       version='0.0.1',
       description='Generic utilities shared by PHA software',
@@ -1,5 +1,5 @@
 import lmdb, msgpack
-import time, datetime, shutil, os
+import time, datetime, shutil, os, struct, itertools, functools
 import numpy as np
 from retrying import retry
 try:
@@ -20,9 +20,35 @@ def timestamp():
     return '{:%Y.%m.%d_}'.format(datetime.datetime.now()) + str(time.time())
 
 _allowed_serialization_types = ['msgpack', 'pickle']
+# 'int64' stores each value as 8 raw (native endian) bytes, 'raw' as the bytes of a val_dtype
+_fixed_width_val_serialization_types = ['int64', 'raw']
+_allowed_val_serialization_types = (_allowed_serialization_types
+                                    + _fixed_width_val_serialization_types)
+
+_int64 = struct.Struct('=q')
+
+# number of entries keys_array/values_array join per step
+_array_chunk = 1 << 16
+
+# number of items __repr__ shows
+_repr_items = 10
+
+# environment tunables, which InterDict takes as keywords (and InterDictFactory as arguments)
+_default_map_size = int(1e10)
+_default_max_readers = 253
+
+# lmdb.open flags for each durability:  'sync' flushes every commit to disk before it
+# returns, 'async' starts the flush at each commit without waiting for it, and 'fast'
+# leaves flushing to the OS (and to flush() or close()), so a system crash can lose
+# recent commits, though never corrupt the database.
+_durability_flags = {
+    'sync': dict(writemap=True, map_async=False, sync=True, metasync=True),
+    'async': dict(writemap=True, map_async=True),
+    'fast': dict(writemap=True, sync=False, metasync=False),
+}
 
 def _validate_and_set_serialization_args(self, convert_int, key_serialization,
-        val_serialization, integer_keys):
+        val_serialization, integer_keys, val_dtype=None):
     if not integer_keys and  key_serialization not in _allowed_serialization_types:
         raise Exception('If integer_keys is False, then valid key_serialization must be given!')
     if convert_int and key_serialization is not None:
@@ -35,30 +61,75 @@ def _validate_and_set_serialization_args(self, convert_int, key_serialization,
         self.key_serialization = key_serialization
     else:
         raise Exception('Invalid key_serialization requested!')
-    if val_serialization in _allowed_serialization_types:
+    if val_serialization in _allowed_val_serialization_types:
         self.val_serialization = val_serialization
     else:
         raise Exception('Invalid val_serialization requested!')
+    if val_serialization in _fixed_width_val_serialization_types:
+        self.val_dtype = np.dtype('int64' if val_dtype is None else val_dtype)
+        if val_serialization == 'int64' and self.val_dtype != np.dtype('int64'):
+            raise Exception('val_serialization int64 needs an int64 val_dtype!')
+        if self.val_dtype.hasobject:
+            raise Exception('val_dtype must not hold python objects!')
+    elif val_dtype is not None:
+        raise Exception('val_dtype is only used with int64 or raw val_serialization!')
+    else:
+        self.val_dtype = None
     if key_serialization is not None or convert_int:
         self.convert_key = True
 
+def _replayable(arg):
+    """ arg, as a list if it is a one-shot iterator that a retried call would find used up """
+    if isinstance(arg, collections.Iterator):
+        return list(arg)
+    return arg
+
+def _adapts_map(method):
+    """
+    Decorates InterDict methods which each run in one transaction.  If the map fills up it is
+    grown (when auto_grow is set), or if another process has grown it the new size is
+    adopted, and the method is run again.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        args = [_replayable(arg) for arg in args]
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except lmdb.MapFullError:
+                if not self.auto_grow:
+                    raise
+                self._grow_map()
+            except lmdb.MapResizedError:
+                self.env.set_mapsize(0)
+    return wrapper
+
 class InterDictFactory(object):
     def __init__(self, dbdir, overwrite_existing=True, convert_int=True,
             append_timestamp=True, key_serialization=None,
-            val_serialization='msgpack', integer_keys=True):
+            val_serialization='msgpack', integer_keys=True, val_dtype=None,
+            map_size=_default_map_size, max_readers=_default_max_readers,
+            durability='async', auto_grow=True):
 
         self.dbdir = dbdir
         self.overwrite_existing = overwrite_existing
         self.append_timestamp = append_timestamp
+        if durability not in _durability_flags:
+            raise Exception('Invalid durability requested!')
+        self.env_kwargs = dict(map_size=map_size, max_readers=max_readers,
+                durability=durability, auto_grow=auto_grow)
 
         _validate_and_set_serialization_args(self, convert_int,
-                key_serialization, val_serialization, integer_keys) 
+                key_serialization, val_serialization, integer_keys, val_dtype) 
 
     def __call__(self, *args, **kwargs):
         if self.append_timestamp:
             dbdir = '%s.%s' % (self.dbdir, timestamp())
         else:
             dbdir = self.dbdir
+        kwargs.setdefault('val_dtype', self.val_dtype)
+        for k, v in self.env_kwargs.items():
+            kwargs.setdefault(k, v)
         d = InterDict(dbdir, self.overwrite_existing, self.convert_int,
                 self.key_serialization, self.val_serialization, self.integer_keys,
                 *args, **kwargs)
@@ -74,7 +145,19 @@ class InterDict(dict):
     vals are string/bytes based.
     
     To be more useful in python, InterDicts can take python objects and serialize them with either
-    pickle or msgpack for either or both of keys and vals.
+    pickle or msgpack for either or both of keys and vals.  Integer vals can instead be stored
+    as raw 8 byte int64s with val_serialization='int64'.  With val_serialization='raw' vals are
+    stored as the raw bytes of a fixed numpy dtype, given by the val_dtype keyword (int64 by
+    default; float64 and structured dtypes work too), and read back as numpy scalars.  These
+    are copies rather than views of the stored bytes, since lmdb's buffers are only valid
+    until their transaction ends; the same goes for the arrays from values_array(), which
+    reads fixed width vals in bulk.
+
+    The lmdb environment is tuned by the keywords map_size (the most the database may grow to
+    before it has to be resized; address space is reserved for all of it, 10 GB by default),
+    max_readers, durability ('sync', 'async' or 'fast'; see _durability_flags) and auto_grow.
+    With auto_grow (the default) a transaction which fills the map doubles its size and
+    is retried.
 
     """
     def get_packing_functions(self):
@@ -98,6 +181,18 @@ class InterDict(dict):
         elif self.val_serialization == 'pickle':
             vpf = lambda x: pickle.dumps(x, protocol=2)
             vupf = lambda x: pickle.loads(bytes(x))
+        elif self.val_serialization == 'int64':
+            vpf = lambda x: _int64.pack(x)
+            vupf = lambda x: _int64.unpack_from(x)[0]
+        elif self.val_serialization == 'raw':
+            dtype = self.val_dtype
+            def vpf(x):
+                raw = np.asarray(x, dtype=dtype).tobytes()
+                if len(raw) != dtype.itemsize:
+                    raise ValueError('val does not fit val_dtype %s' % dtype)
+                return raw
+            # copied, since the buffer is only valid within its transaction
+            vupf = lambda x: np.frombuffer(x, dtype=dtype).copy()[0]
         elif self.val_serialization is None:
             vpf = lambda x: x
             vupf = lambda x: x
@@ -116,16 +211,23 @@ class InterDict(dict):
         self.dbdir = dbdir if isinstance(dbdir, bytes) else dbdir.encode()
 
         _validate_and_set_serialization_args(self, convert_int,
-                key_serialization, val_serialization, integer_keys) 
+                key_serialization, val_serialization, integer_keys,
+                kwargs.pop('val_dtype', None))
 
         self.pack_key,self.unpack_key,self.pack_val,self.unpack_val = self.get_packing_functions()
 
+        map_size = kwargs.pop('map_size', _default_map_size)
+        self.max_readers = kwargs.pop('max_readers', _default_max_readers)
+        self.durability = kwargs.pop('durability', 'async')
+        self.auto_grow = kwargs.pop('auto_grow', True)
+        if self.durability not in _durability_flags:
+            raise Exception('Invalid durability requested!')
+
         self.env = lmdb.open(dbdir, max_dbs=1,
-                map_size=int(1e10),
-                max_readers=253,
-                map_async=True,
-                writemap=True,
-                max_spare_txns=126
+                map_size=map_size,
+                max_readers=self.max_readers,
+                max_spare_txns=126,
+                **_durability_flags[self.durability]
                 )
         self.db = self.env.open_db(b'db', integerkey=self.integer_keys)
 
@@ -137,6 +239,7 @@ class InterDict(dict):
     def int(self, i):
         return np.int64(i)
 
+    @_adapts_map
     def __setitem__(self, key, val):
         try:
             with self.env.begin(write=True, buffers=True) as txn:
@@ -144,6 +247,7 @@ class InterDict(dict):
         except Exception as e:
             raise
 
+    @_adapts_map
     @retry(wait_fixed=100, stop_max_attempt_number=10, retry_on_exception=retryable)
     def __getitem__(self, key):
         try:
@@ -152,6 +256,7 @@ class InterDict(dict):
         except Exception as e:
             raise
 
+    @_adapts_map
     def __delitem__(self, key):
         try:
             with self.env.begin(write=True, buffers=True) as txn:
@@ -159,11 +264,13 @@ class InterDict(dict):
         except Exception as e:
             raise
 
+    @_adapts_map
     @retry(wait_fixed=100, stop_max_attempt_number=10, retry_on_exception=retryable)
     def __contains__(self, key):
         with self.env.begin(write=False, buffers=True) as txn:
             return txn.get(self.pack_key(key), db=self.db) is not None
 
+    @_adapts_map
     def __len__(self):
         with self.env.begin(write=False, buffers=True) as txn:
             return txn.stat(db=self.db)['entries']
@@ -206,60 +313,226 @@ class InterDict(dict):
             dbdir = self.dbdir + b'.copied.' + (timestamp()).encode()
         else:
             dbdir = dbdir if isinstance(dbdir, bytes) else dbdir.encode()
-        copy = type(self)(dbdir, overwrite_existing)
+        copy = type(self)(dbdir, overwrite_existing, self.convert_int,
+                self.key_serialization, self.val_serialization, self.integer_keys,
+                val_dtype=self.val_dtype, map_size=self.env.info()['map_size'],
+                max_readers=self.max_readers, durability=self.durability,
+                auto_grow=self.auto_grow)
         copy.update(self)
         return copy
 
+    @_adapts_map
     def keys(self):
-        with self.env.begin(write=False, buffers=True) as txn:
-            if self.integer_keys:
-                return [np.frombuffer(key, dtype='int64')[0] for key,_ in txn.cursor(db=self.db)]
-            else:
-                return [self.unpack_key(key) for key,_ in txn.cursor(db=self.db)]
-            
-    def keyRange(self, kMin, kMax):
-        kMin = self.pack_key(kMin)
-        kMax = self.pack_key(kMax)
-
-        ret = []
-        with self.env.begin(write=False, buffers=True) as txn:
-            if self.integer_keys:
-                cursor =  txn.cursor(db=self.db)
-                cursor.set_range(kMin)
-                for key,_ in cursor:
-                    key = np.frombuffer(key, dtype='int64')[0]
-                    if key > kMax:
-                        return ret
-                    ret.append(key)
-                return ret
-            else:
-                cursor =  txn.cursor(db=self.db)
-                cursor.set_range(kMin)
-                for key,_ in cursor:
-                    key = self.unpack_key(key)
-                    if key > kMax:
-                        return ret
-                    ret.append(key)
-                return ret
+        return list(self.iterkeys())
 
-        
+    @_adapts_map
+    def keyRange(self, kMin, kMax, reverse=False):
+        return list(self.iterrange(kMin, kMax, reverse))
 
+    @_adapts_map
     def values(self):
-        with self.env.begin(write=False, buffers=True) as txn:
-            return [self.unpack_val(val) for _,val in txn.cursor(db=self.db)]
+        return list(self.itervalues())
 
-    def iteritems(self):
-        with self.env.begin(write=False, buffers=True) as txn:
-            if self.integer_keys:
-                for key, val in txn.cursor(db=self.db):
-                    yield np.frombuffer(key, dtype='int64')[0], self.unpack_val(val)
-            else:
-                for key, val in txn.cursor(db=self.db):
-                    yield self.unpack_key(key), self.unpack_val(val)
+    @_adapts_map
+    def count_range(self, kMin=None, kMax=None):
+        """ The number of keys from kMin to kMax (inclusive; None leaves that end open) """
+        if kMin is None and kMax is None:
+            return len(self)
+        self._check_range(kMin, kMax)
+        return sum(len(keys) for keys in self._scan(kMin, kMax, False, _array_chunk, 'keys'))
+
+    def iterkeys(self, batch_size=None):
+        """ Yields the keys in order, singly or in batches as for iterrange """
+        return self._scan(None, None, False, batch_size, 'keys')
+
+    def itervalues(self, batch_size=None):
+        """
+        Yields the vals in key order, singly or with batch_size in batches of up to that many:
+        arrays of val_dtype for int64 or raw val_serialization, otherwise lists.
+        """
+        return self._scan(None, None, False, batch_size, 'vals')
+
+    def iterrange(self, kMin=None, kMax=None, reverse=False, batch_size=None):
+        """
+        Yields the keys from kMin to kMax (inclusive; None leaves that end open) in order, or
+        from kMax down to kMin if reverse is set.  With batch_size the keys come in batches
+        of up to that many: int64 arrays for integer keys, otherwise lists.  The keys are
+        read lazily, within one read transaction which lasts until the generator finishes.
+        Integer keys are in LMDB's order, which is numeric order for non-negative keys.
+
+        Bounds need integer keys: serialized keys are stored in the byte order of their
+        msgpack or pickle encodings, which is not the order of the keys themselves, so a
+        range of them would be meaningless.
+        """
+        self._check_range(kMin, kMax)
+        return self._scan(kMin, kMax, reverse, batch_size, 'keys')
+
+    def _check_range(self, kMin, kMax):
+        if (kMin is not None or kMax is not None) and \
+                (not self.integer_keys or self.key_serialization is not None):
+            raise Exception('key ranges need integer keys, not %s serialized ones!'
+                            % self.key_serialization)
+
+    def _decode_key(self, key):
+        if self.integer_keys:
+            return np.frombuffer(key, dtype='int64')[0]
+        return self.unpack_key(key)
+
+    def _decode_keys(self, raw_keys):
+        if self.integer_keys:
+            return np.frombuffer(b''.join(raw_keys), dtype='int64').copy()
+        return [self.unpack_key(key) for key in raw_keys]
+
+    def _decode_vals(self, raw_vals):
+        if self.val_dtype is not None:
+            return np.frombuffer(b''.join(raw_vals), dtype=self.val_dtype).copy()
+        return [self.unpack_val(val) for val in raw_vals]
+
+    def _seek(self, cursor, kMin, kMax, reverse):
+        """
+        Put cursor on the first entry of a scan, returning False if there is none.  LMDB
+        orders integer keys as unsigned, so a negative bound is taken to lie before all the
+        (non-negative) keys.
+        """
+        negative = lambda k: self.integer_keys and k < 0
+        if not reverse:
+            if kMin is None or negative(kMin):
+                return cursor.first()
+            return cursor.set_range(self.pack_key(kMin))
+        if kMax is not None and negative(kMax):
+            return False
+        if kMax is None or not cursor.set_range(self.pack_key(kMax)):
+            return cursor.last()
+        if self._decode_key(cursor.key()) > kMax:
+            return cursor.prev()
+        return True
+
+    def _scan(self, kMin, kMax, reverse, batch_size, want):
+        """
+        The generator behind the iter* methods.  Yields the keys, vals or (key, val) pairs
+        (want is 'keys', 'vals' or 'items') from kMin to kMax, singly or, with batch_size,
+        as batches of keys, of vals, or (keys, vals) pairs of batches.
+        """
+        stop = kMin if reverse else kMax
+        want_vals = want != 'keys'
+        # keys are only needed to return them or to see where the scan ends
+        need_keys = want != 'vals' or stop is not None
+        # a single entry is decoded straight from the map; a batch is joined from copies
+        with self.env.begin(write=False, buffers=batch_size is None) as txn:
+            cursor = txn.cursor(db=self.db)
+            if not self._seek(cursor, kMin, kMax, reverse):
+                return
+            step = cursor.iterprev if reverse else cursor.iternext
+            entries = step(keys=need_keys, values=want_vals)
+            if batch_size is None:
+                if not need_keys:
+                    for val in entries:
+                        yield self.unpack_val(val)
+                    return
+                for entry in entries:
+                    if want_vals:
+                        key, val = entry
+                    else:
+                        key = entry
+                    key = self._decode_key(key)
+                    if stop is not None and (key < stop if reverse else key > stop):
+                        return
+                    if want == 'keys':
+                        yield key
+                    elif want == 'vals':
+                        yield self.unpack_val(val)
+                    else:
+                        yield key, self.unpack_val(val)
+                return
+            while True:
+                chunk = list(itertools.islice(entries, batch_size))
+                if not chunk:
+                    return
+                if not need_keys:
+                    yield self._decode_vals(chunk)
+                    continue
+                if want_vals:
+                    raw_keys, raw_vals = zip(*chunk)
+                else:
+                    raw_keys = chunk
+                keys = self._decode_keys(raw_keys)
+                n = len(keys)
+                if stop is not None:
+                    if self.integer_keys:
+                        beyond = np.flatnonzero(keys < stop if reverse else keys > stop)
+                        if len(beyond):
+                            n = beyond[0]
+                    else:
+                        for i, key in enumerate(keys):
+                            if key < stop if reverse else key > stop:
+                                n = i
+                                break
+                    keys = keys[:n]
+                if n > 0:
+                    if want == 'keys':
+                        yield keys
+                    elif want == 'vals':
+                        yield self._decode_vals(raw_vals[:n])
+                    else:
+                        yield keys, self._decode_vals(raw_vals[:n])
+                if n < len(chunk):
+                    return
+
+    def _fill_array(self, txn, entries, dtype, out):
+        """ Fill out (or a new array) from the raw entries, joining them a chunk at a time """
+        n = txn.stat(db=self.db)['entries']
+        if out is None:
+            out = np.empty(n, dtype=dtype)
+        elif len(out) < n:
+            raise ValueError('out has room for %d of the %d entries' % (len(out), n))
+        width = dtype.itemsize
+        pos = 0
+        while True:
+            chunk = list(itertools.islice(entries, _array_chunk))
+            if not chunk:
+                break
+            raw = b''.join(chunk)
+            if len(raw) != width * len(chunk):
+                raise ValueError('entries are not all %d bytes wide' % width)
+            out[pos:pos + len(chunk)] = np.frombuffer(raw, dtype=dtype)
+            pos += len(chunk)
+        return out[:pos]
+
+    @_adapts_map
+    def keys_array(self, out=None):
+        """
+        All the (integer) keys in order as an int64 array, read in one cursor pass.  If out
+        is given the keys are stored in it, and the filled part of it is returned.
+        """
+        if not self.integer_keys:
+            raise Exception('keys_array needs integer_keys!')
+        with self.env.begin(write=False) as txn:
+            cursor = txn.cursor(db=self.db)
+            return self._fill_array(txn, cursor.iternext(keys=True, values=False),
+                                    np.dtype('int64'), out)
+
+    @_adapts_map
+    def values_array(self, out=None):
+        """
+        All the vals in key order as an array of val_dtype, read in one cursor pass.  This
+        needs int64 or raw val_serialization.  If out is given the vals are stored in it,
+        and the filled part of it is returned.
+        """
+        if self.val_dtype is None:
+            raise Exception('values_array needs int64 or raw val_serialization!')
+        with self.env.begin(write=False) as txn:
+            cursor = txn.cursor(db=self.db)
+            return self._fill_array(txn, cursor.iternext(keys=False, values=True),
+                                    self.val_dtype, out)
+
+    def iteritems(self, batch_size=None):
+        """ Yields the (key, val) pairs in key order, or (keys, vals) batches as for iterrange """
+        return self._scan(None, None, False, batch_size, 'items')
     
     def items(self):
         return [tpl for tpl in self.iteritems()]
 
+    @_adapts_map
     def mset(self, items):
         try:
             with self.env.begin(write=True, buffers=True) as txn:
@@ -268,6 +541,50 @@ class InterDict(dict):
         except Exception as e:
             raise
 
+    def _grow_map(self):
+        """ Double the size of the memory map """
+        self.env.set_mapsize(2 * self.env.info()['map_size'])
+
+    def bulk_load(self, sorted_items, batch_size=1 << 16, grow=None):
+        """
+        Load (key, val) pairs whose keys increase in LMDB order (numerically for non-negative
+        integer keys) and all come after the keys already stored.  This uses LMDB's append
+        mode, which fills pages sequentially instead of searching the tree, with one putmulti
+        and transaction per batch_size items.  If grow (by default auto_grow) is set and the
+        map fills up, the map size is doubled and the batch retried; if another process has
+        grown the map, its new size is adopted and the batch retried.  Raises ValueError at
+        the first batch that is out of order; the batches before it stay loaded.  Returns
+        the number of items loaded.
+        """
+        if grow is None:
+            grow = self.auto_grow
+        # the same bytes as np.int64(key), without building a numpy scalar per key
+        pack_key = _int64.pack if self.convert_int else self.pack_key
+        pack_val = self.pack_val
+        items = iter(sorted_items)
+        loaded = 0
+        while True:
+            batch = [(pack_key(key), pack_val(val))
+                     for key, val in itertools.islice(items, batch_size)]
+            if not batch:
+                return loaded
+            while True:
+                try:
+                    with self.env.begin(write=True) as txn:
+                        consumed, added = txn.cursor(db=self.db).putmulti(batch, append=True)
+                        if added != len(batch):
+                            raise ValueError('bulk_load needs items sorted by increasing key, '
+                                             'after the keys already stored')
+                    break
+                except lmdb.MapFullError:
+                    if not grow:
+                        raise
+                    self._grow_map()
+                except lmdb.MapResizedError:
+                    self.env.set_mapsize(0)
+            loaded += len(batch)
+
+    @_adapts_map
     def mset_single_value(self, keys, val):
         """ Set multiple keys to the same value, within a single transaction """
         try:
@@ -285,6 +602,7 @@ class InterDict(dict):
         except Exception as e:
             raise
 
+    @_adapts_map
     def mdel(self, keys):
         try:
             with self.env.begin(write=True, buffers=True) as txn:
@@ -303,7 +621,16 @@ class InterDict(dict):
             raise
 
     def __repr__(self):
-        return '{0}({1})'.format(type(self).__name__, str(self.items()))
+        """ Shows just the first _repr_items items, and how many there are in all """
+        entries = self.iteritems()
+        try:
+            head = list(itertools.islice(entries, _repr_items))
+        finally:
+            entries.close()  # ends the read transaction
+        n = len(self)
+        more = ', ...' if n > len(head) else ''
+        return '{0}([{1}{2}], {3} items)'.format(type(self).__name__,
+                                                ', '.join(repr(item) for item in head), more, n)
 
     def flush(self):
         self.env.sync()
@@ -313,7 +640,18 @@ class InterDict(dict):
 
 
 class IntValueInterDict(InterDict):
+    """
+    An InterDict of integer vals, which can be debited and credited.  With raw
+    val_serialization the val_dtype must be an integer dtype.
+    """
+
+    def __init__(self, *args, **kwargs):
+        val_dtype = kwargs.get('val_dtype')
+        if val_dtype is not None and np.dtype(val_dtype).kind not in 'iu':
+            raise Exception('IntValueInterDict needs an integer val_dtype!')
+        super(IntValueInterDict, self).__init__(*args, **kwargs)
 
+    @_adapts_map
     def debit(self, key, amount, min_remaining=np.iinfo('int').min):
         try:
             with self.env.begin(write=True, buffers=True) as txn:
@@ -332,6 +670,7 @@ class IntValueInterDict(InterDict):
         except Exception as e:
             raise
 
+    @_adapts_map
     def credit(self, key, amount, max_remaining=np.iinfo('int').max):
         try:
             with self.env.begin(write=True, buffers=True) as txn:
@@ -350,7 +689,41 @@ class IntValueInterDict(InterDict):
         except Exception as e:
             raise
 
+    def _packed_keys(self, keys):
+        """ The packed form of each of keys, converted in one step if convert_int is set """
+        if self.convert_int:
+            raw = np.asarray(keys, dtype=np.int64).tobytes()
+            return [raw[i:i + 8] for i in range(0, len(raw), 8)]
+        return [self.pack_key(key) for key in keys]
+
+    def _get_vals_array(self, txn, keys, packed_keys):
+        """ The current vals of keys as one int array """
+        if self.val_dtype is not None:
+            raw = [txn.get(key, db=self.db) for key in packed_keys]
+            if None in raw:
+                raise KeyError(keys[raw.index(None)])
+            return np.frombuffer(b''.join(raw), dtype=self.val_dtype).astype(int)
+        return np.asarray([self.unpack_val(txn.get(key, db=self.db)) for key in packed_keys],
+                          dtype=int)
+
+    def _put_vals_array(self, txn, packed_keys, vals):
+        """ Store vals under packed_keys with a single putmulti """
+        if self.val_dtype is not None:
+            width = self.val_dtype.itemsize
+            raw = vals.astype(self.val_dtype).tobytes()
+            packed_vals = [raw[i:i + width] for i in range(0, len(raw), width)]
+        else:
+            packed_vals = [self.pack_val(int(val)) for val in vals]
+        txn.cursor(db=self.db).putmulti(zip(packed_keys, packed_vals))
+
+    @_adapts_map
     def mdebit(self, keys, amount, min_remaining=np.iinfo('int').min):
+        """
+        Debit each of keys by amount (a scalar or one per key), without taking a val below
+        min_remaining.  Vals already below min_remaining are left alone.  Returns the new
+        vals and the part of each amount which could not be debited.  All vals are read,
+        updated as arrays and written back within a single transaction.
+        """
         assert(isinstance(keys, collections.Iterable))
         if isinstance(amount, collections.Iterable):
             assert(len(keys)==len(amount))
@@ -362,31 +735,30 @@ class IntValueInterDict(InterDict):
             min_remaining = np.asarray(min_remaining, dtype=int)
         else:
             min_remaining = np.zeros(len(keys), dtype=int) + min_remaining
+        packed_keys = self._packed_keys(keys)
         try:
-            with self.env.begin(write=True, buffers=True) as txn:
-                cur_vals = []
-                for key in keys:
-                    cur_vals.append(self.unpack_val(
-                        txn.get(self.pack_key(key), db=self.db)))
-                vals = np.asarray(cur_vals, dtype=int)
-                remaining_debit_amount = np.zeros(len(keys), dtype=int)
-                for key,i in zip(keys, range(len(vals))):
-                    if vals[i] < min_remaining[i]:
-                        remaining_debit_amount[i] = amount[i]
-                    else:
-                        vals[i] = vals[i] - amount[i]
-                        if vals[i] < min_remaining[i]:
-                            remaining_debit_amount[i] = min_remaining[i] - vals[i]
-                            vals[i] = min_remaining[i]
-                        else:
-                            remaining_debit_amount[i] = 0
-                    val = int(vals[i])
-                    txn.put(self.pack_key(key), self.pack_val(val), db=self.db)
+            with self.env.begin(write=True) as txn:
+                vals = self._get_vals_array(txn, keys, packed_keys)
+                below = vals < min_remaining
+                debited = vals - amount
+                # only take the difference where the val was clamped, since with the default
+                # bound it overflows elsewhere
+                remaining_debit_amount = np.where(below, amount,
+                        np.where(debited < min_remaining, min_remaining - debited, 0))
+                vals = np.where(below, vals, np.maximum(debited, min_remaining))
+                self._put_vals_array(txn, packed_keys, vals)
                 return vals, remaining_debit_amount
         except Exception as e:
             raise
 
+    @_adapts_map
     def mcredit(self, keys, amount, max_remaining=np.iinfo('int').max):
+        """
+        Credit each of keys by amount (a scalar or one per key), without taking a val above
+        max_remaining.  Vals already above max_remaining are left alone.  Returns the new
+        vals and the part of each amount which could not be credited.  All vals are read,
+        updated as arrays and written back within a single transaction.
+        """
         assert(isinstance(keys, collections.Iterable))
         if isinstance(amount, collections.Iterable):
             assert(len(keys)==len(amount))
@@ -398,31 +770,28 @@ class IntValueInterDict(InterDict):
             max_remaining = np.asarray(max_remaining, dtype=int)
         else:
             max_remaining = np.zeros(len(keys), dtype=int) + max_remaining
+        packed_keys = self._packed_keys(keys)
         try:
-            with self.env.begin(write=True, buffers=True) as txn:
-                cur_vals = []
-                for key in keys:
-                    cur_vals.append(self.unpack_val(
-                        txn.get(self.pack_key(key), db=self.db)))
-                vals = np.asarray(cur_vals, dtype=int)
-                remaining_credit_amount = np.zeros(len(keys), dtype=int)
-                for key,i in zip(keys, range(len(vals))):
-                    if vals[i] > max_remaining[i]:
-                        remaining_credit_amount[i] = amount[i]
-                    else:
-                        vals[i] = vals[i] + amount[i]
-                        if vals[i] > max_remaining[i]:
-                            remaining_credit_amount[i] = vals[i] - max_remaining[i]
-                            vals[i] = max_remaining[i]
-                        else:
-                            remaining_credit_amount[i] = 0
-                    val = int(vals[i])
-                    txn.put(self.pack_key(key), self.pack_val(val), db=self.db)
+            with self.env.begin(write=True) as txn:
+                vals = self._get_vals_array(txn, keys, packed_keys)
+                above = vals > max_remaining
+                credited = vals + amount
+                # only take the difference where the val was clamped, as in mdebit
+                remaining_credit_amount = np.where(above, amount,
+                        np.where(credited > max_remaining, credited - max_remaining, 0))
+                vals = np.where(above, vals, np.minimum(credited, max_remaining))
+                self._put_vals_array(txn, packed_keys, vals)
                 return vals, remaining_credit_amount
         except Exception as e:
             raise
 
+    @_adapts_map
     def mcredit_from_pool(self, keys, pool, max_remaining):
+        """
+        Fill keys up to max_remaining in order from a pool of the given size, until the
+        pool runs out.  Returns the new vals and what is left of the pool.  Keys after the
+        one which empties the pool are not written.
+        """
         assert(isinstance(keys, collections.Iterable))
         assert(not isinstance(pool, collections.Iterable))
         if isinstance(max_remaining, collections.Iterable):
@@ -430,32 +799,31 @@ class IntValueInterDict(InterDict):
             max_remaining = np.asarray(max_remaining, dtype=int)
         else:
             max_remaining = np.zeros(len(keys), dtype=int) + max_remaining
+        packed_keys = self._packed_keys(keys)
         try:
-            with self.env.begin(write=True, buffers=True) as txn:
-                cur_vals = []
-                for key in keys:
-                    cur_vals.append(self.unpack_val(
-                        txn.get(self.pack_key(key), db=self.db)))
-                vals = np.asarray(cur_vals, dtype=int)
-                for key,i in zip(keys, range(len(vals))):
-                    if vals[i] < max_remaining[i]:
-                        if pool >= max_remaining[i] - vals[i]:
-                            pool -= max_remaining[i] - vals[i]
-                            vals[i] = max_remaining[i]
-                        else:
-                            vals[i] += pool
-                            pool = 0
-                    val = int(vals[i])
-                    txn.put(self.pack_key(key), self.pack_val(val), db=self.db)
-                    if pool < 0:
+            with self.env.begin(write=True) as txn:
+                vals = self._get_vals_array(txn, keys, packed_keys)
+                if len(vals) == 0:
+                    return vals, pool
+                needed = np.where(vals < max_remaining, max_remaining - vals, 0)
+                filled = np.cumsum(needed)
+                # the pool is empty after the first key at which filled reaches it
+                last = int(np.searchsorted(filled, pool, side='left'))
+                if last == len(vals):
+                    vals += needed
+                    pool -= int(filled[-1])
+                else:
+                    if pool < 0 and needed[last] == 0:
                         raise Exception()
-                    elif pool == 0:
-                        break
+                    vals[:last] += needed[:last]
+                    vals[last] += pool - (int(filled[last - 1]) if last > 0 else 0)
+                    pool = 0
+                self._put_vals_array(txn, packed_keys[:last + 1], vals[:last + 1])
                 return vals, pool
         except Exception as e:
             raise
 
-import unittest, tempfile
+import unittest, tempfile, subprocess, sys
 
 class TestInterDictFactory(unittest.TestCase):
 
@@ -479,5 +847,205 @@ class TestInterDictFactory(unittest.TestCase):
                 self.assertIn(k, d)
                 self.assertEqual(v,d[k])
 
+class TestRawInterDict(unittest.TestCase):
+
+    def test_raw_values(self):
+        d = InterDict(tempfile.mkdtemp(), True, True, None, 'raw', val_dtype='float64')
+        d.update(zip([5, 1, 3], [0.5, 1.5, -2.0]))
+        self.assertEqual(d[1], 1.5)
+        self.assertTrue(isinstance(d[1], np.float64))
+        self.assertEqual(list(d.keys_array()), [1, 3, 5])
+        self.assertEqual(list(d.values_array()), [1.5, -2.0, 0.5])
+        out = np.zeros(5)
+        self.assertEqual(list(d.values_array(out)), [1.5, -2.0, 0.5])
+        self.assertEqual(list(out), [1.5, -2.0, 0.5, 0.0, 0.0])
+        self.assertRaises(ValueError, d.keys_array, np.zeros(2, dtype=np.int64))
+        self.assertEqual(d.copy().items(), d.items())
+
+    def test_structured_values(self):
+        dtype = np.dtype([('count', 'i8'), ('weight', 'f8')])
+        f = InterDictFactory(tempfile.mkdtemp(), val_serialization='raw', val_dtype=dtype)
+        d = f()
+        d[2] = (4, 0.25)
+        d[1] = np.array((7, 1.0), dtype=dtype)
+        self.assertEqual(d[2]['count'], 4)
+        self.assertEqual(d[1]['weight'], 1.0)
+        vals = d.values_array()
+        self.assertEqual(vals.dtype, dtype)
+        self.assertEqual(list(vals['count']), [7, 4])
+        self.assertRaises(ValueError, d.__setitem__, 3, [(1, 1.0), (2, 2.0)])
+
+    def test_invalid_args(self):
+        self.assertRaises(Exception, InterDict, tempfile.mkdtemp(), True, True, None, 'msgpack',
+                          val_dtype='float64')
+        self.assertRaises(Exception, InterDictFactory, tempfile.mkdtemp(),
+                          val_serialization='int64', val_dtype='float64')
+        d = InterDict(tempfile.mkdtemp(), True, True)
+        self.assertRaises(Exception, d.values_array)
+
+class TestBulkLoad(unittest.TestCase):
+
+    def test_bulk_load(self):
+        d = InterDict(tempfile.mkdtemp(), True, True, map_size=1 << 16)
+        n = 20000
+        self.assertEqual(d.bulk_load(((i, [i, 'x' * 20]) for i in range(n)), batch_size=1000), n)
+        self.assertGreater(d.env.info()['map_size'], 1 << 16)
+        self.assertEqual(len(d), n)
+        self.assertEqual(d[1234], [1234, 'x' * 20])
+        self.assertEqual(d.bulk_load([(n, 'a'), (n + 5, 'b')]), 2)
+        self.assertEqual(d.keyRange(n - 1, n + 10), [n - 1, n, n + 5])
+
+        self.assertRaises(ValueError, d.bulk_load, [(n + 7, 'c'), (n + 6, 'd')])
+        self.assertNotIn(n + 7, d)
+        self.assertRaises(ValueError, d.bulk_load, [(3, 'e')])
+
+        d = InterDict(tempfile.mkdtemp(), True, True, map_size=1 << 16, auto_grow=False)
+        self.assertRaises(lmdb.MapFullError, d.bulk_load, ((i, 'x' * 100) for i in range(n)))
+
+    def test_map_resized_elsewhere(self):
+        d = InterDict(tempfile.mkdtemp(), True, True, None, 'int64', map_size=1 << 16)
+        d[0] = 0
+        # another process grows the map well past the size this one has mapped
+        grow = ('import lmdb, struct\n'
+                'env = lmdb.open(%r, max_dbs=1, map_size=1 << 22, writemap=True)\n'
+                'with env.begin(write=True) as txn:\n'
+                '    db = env.open_db(b"db", txn=txn, integerkey=True)\n'
+                '    for i in range(1, 20000):\n'
+                '        txn.put(struct.pack("=q", i), struct.pack("=q", i), db=db)\n'
+                'env.close()\n' % d.dbdir)
+        subprocess.check_call([sys.executable, '-c', grow])
+        self.assertEqual(d.bulk_load([(20000, 1), (20001, 2)]), 2)
+        self.assertEqual(d.env.info()['map_size'], 1 << 22)
+        self.assertEqual((len(d), d[19999], d[20001]), (20002, 19999, 2))
+
+class TestEnvironmentTuning(unittest.TestCase):
+
+    def test_auto_grow(self):
+        f = InterDictFactory(tempfile.mkdtemp(), map_size=1 << 16, durability='fast')
+        d = f()
+        self.assertEqual(d.env.info()['map_size'], 1 << 16)
+        self.assertEqual(d.durability, 'fast')
+        n = 5000
+        d.update(((i, 'x' * 50) for i in range(n)))
+        self.assertEqual(len(d), n)
+        self.assertGreater(d.env.info()['map_size'], 1 << 16)
+        d.mset_single_value(range(n, 2 * n), 'y' * 50)
+        self.assertEqual(d[2 * n - 1], 'y' * 50)
+        self.assertEqual(len(d.copy()), 2 * n)
+
+    def test_no_auto_grow(self):
+        d = InterDict(tempfile.mkdtemp(), True, True, map_size=1 << 16, auto_grow=False,
+                      durability='sync')
+        self.assertRaises(lmdb.MapFullError, d.update, ((i, 'x' * 50) for i in range(5000)))
+        self.assertEqual(len(d), 0)
+        d[1] = 'a'
+        self.assertEqual(d[1], 'a')
+
+    def test_invalid_durability(self):
+        self.assertRaises(Exception, InterDictFactory, tempfile.mkdtemp(), durability='never')
+        self.assertRaises(Exception, InterDict, tempfile.mkdtemp(), durability='never')
+
+class TestIterators(unittest.TestCase):
+
+    def setUp(self):
+        self.d = InterDict(tempfile.mkdtemp(), True, True, None, 'raw')
+        self.d.bulk_load((k, 10 * k) for k in range(0, 40, 3))
+
+    def test_iterrange(self):
+        d = self.d
+        self.assertEqual(list(d.iterrange(5, 14)), [6, 9, 12])
+        self.assertEqual(list(d.iterrange(5, 15, reverse=True)), [15, 12, 9, 6])
+        self.assertEqual(list(d.iterrange(kMax=4, reverse=True)), [3, 0])
+        self.assertEqual(list(d.iterrange(37, reverse=True)), [39])
+        self.assertEqual(list(d.iterrange(40)), [])
+        self.assertEqual(list(d.iterrange(-5, 2)), [0])
+        self.assertEqual(d.keyRange(4, 10, reverse=True), [9, 6])
+        batches = list(d.iterrange(2, 30, batch_size=4))
+        self.assertEqual([list(b) for b in batches], [[3, 6, 9, 12], [15, 18, 21, 24], [27, 30]])
+        self.assertTrue(isinstance(batches[0], np.ndarray))
+        self.assertEqual([list(b) for b in d.iterrange(20, reverse=True, batch_size=5)],
+                         [[39, 36, 33, 30, 27], [24, 21]])
+
+    def test_batches(self):
+        d = self.d
+        self.assertEqual(np.concatenate(list(d.iterkeys(batch_size=6))).tolist(), d.keys())
+        vals = list(d.itervalues(batch_size=6))
+        self.assertEqual([len(b) for b in vals], [6, 6, 2])
+        self.assertEqual(np.concatenate(vals).tolist(), d.values())
+        keys, vals = next(d.iteritems(batch_size=3))
+        self.assertEqual((list(keys), list(vals)), ([0, 3, 6], [0, 30, 60]))
+        self.assertEqual(list(d.iteritems())[:2], [(0, 0), (3, 30)])
+
+    def test_count_range(self):
+        d = self.d
+        self.assertEqual(d.count_range(), 14)
+        self.assertEqual(d.count_range(5, 14), 3)
+        self.assertEqual(d.count_range(kMin=30), 4)
+        self.assertEqual(d.count_range(50, 60), 0)
+
+    def test_repr(self):
+        self.assertEqual(repr(self.d).split(', ...')[1], '], 14 items)')
+        self.assertEqual(repr(self.d).count('), ('), 9)
+        small = InterDict(tempfile.mkdtemp(), True, True)
+        small[3] = 'x'
+        self.assertEqual(repr(small), "InterDict([(3, 'x')], 1 items)")
+
+    def test_serialized_key_ranges(self):
+        d = InterDict(tempfile.mkdtemp(), True, False, 'msgpack', integer_keys=False)
+        d.mset([(k, k) for k in (1, 200, 'a')])
+        self.assertEqual(sorted(d.keys()), [1, 200, 'a'])
+        self.assertRaises(Exception, d.iterrange, 1, 300)
+        self.assertRaises(Exception, d.keyRange, 1, 300)
+        self.assertRaises(Exception, d.count_range, kMax=300)
+        self.assertEqual(d.count_range(), 3)
+
+class TestIntValueInterDict(unittest.TestCase):
+
+    def make(self, val_serialization):
+        d = IntValueInterDict(tempfile.mkdtemp(), True, True, None, val_serialization)
+        d.update(zip(range(6), [5, 0, 10, -2, 7, 3]))
+        return d
+
+    def test_int64_values(self):
+        d = self.make('int64')
+        self.assertEqual(d[2], 10)
+        d[2] = -2**62
+        self.assertEqual(d[2], -2**62)
+        self.assertEqual(sorted(d.values()), [-2**62, -2, 0, 3, 5, 7])
+
+    def test_batch_updates(self):
+        for val_serialization in ['msgpack', 'int64', 'raw']:
+            d = self.make(val_serialization)
+            vals, remaining = d.mdebit([0, 1, 2, 3], [3, 3, 15, 1], 0)
+            self.assertEqual(list(vals), [2, 0, 0, -2])
+            self.assertEqual(list(remaining), [0, 3, 5, 1])
+            vals, remaining = d.mcredit([0, 4], 4, [20, 9])
+            self.assertEqual(list(vals), [6, 9])
+            self.assertEqual(list(remaining), [0, 2])
+            vals, pool = d.mcredit_from_pool([1, 2, 4, 5], 12, 8)
+            self.assertEqual(list(vals), [8, 4, 9, 3])
+            self.assertEqual(pool, 0)
+            self.assertEqual([d[k] for k in range(6)], [6, 8, 4, -2, 9, 3])
+
+    def test_integer_val_dtype(self):
+        self.assertRaises(Exception, IntValueInterDict, tempfile.mkdtemp(), True, True, None,
+                          'raw', val_dtype='float64')
+        d = IntValueInterDict(tempfile.mkdtemp(), True, True, None, 'raw', val_dtype='int32')
+        d.update([(0, 5), (1, 7)])
+        vals, remaining = d.mdebit([0, 1], 6, 0)
+        self.assertEqual(list(vals), [0, 1])
+        self.assertEqual(list(remaining), [1, 0])
+        self.assertEqual(d.values_array().dtype, np.dtype('int32'))
+
+    def test_default_bounds(self):
+        for val_serialization in ['msgpack', 'int64', 'raw']:
+            d = self.make(val_serialization)
+            vals, remaining = d.mdebit([0, 2], [3, 4])
+            self.assertEqual(list(vals), [2, 6])
+            self.assertEqual(list(remaining), [0, 0])
+            vals, remaining = d.mcredit([3, 4], 1)
+            self.assertEqual(list(vals), [-1, 8])
+            self.assertEqual(list(remaining), [0, 0])
+
 if __name__ == '__main__':
         unittest.main()
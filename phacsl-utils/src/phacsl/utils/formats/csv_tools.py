@@ -15,11 +15,32 @@
 #                                                                                 #
 ###################################################################################
 
+import os
 import re
 import types
+import heapq
+import hashlib
+import tempfile
+import warnings
+import mmap
+import itertools
+import collections
+import multiprocessing
 import chardet
 import codecs
+import msgpack
+import numpy as np
 from ..misc import util
+from ..collections import phacollections
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+try:
+    from .csvsplit import Splitter
+except ImportError:
+    Splitter = None  # the compiled tokenizer was not built, so the regexes are used
 
 verbose = 0
 debug = 0
@@ -29,8 +50,13 @@ raiseRuntimeError = util.raiseRuntimeError
 getPreferredOutputEncoding = util.getPreferredOutputEncoding
 openByNameOrFile = util.openByNameOrFile
 
+sniffLines = 100  # leading lines used to guess the encoding and delimiter of a file
+
+
+class _CSVRecord(object):
+    "The helper methods shared by the CSVDict and CSVRow record types"
+    __slots__ = ()
 
-class CSVDict(dict):
     def getFloat(self, keyOrKeyList):
         if isinstance(keyOrKeyList, types.ListType):
             for k in keyOrKeyList:
@@ -53,11 +79,169 @@ class CSVDict(dict):
                         return float(self[k])
                 return default
             else:
-                if k in self and self[k] != ignore:
-                    return float(self[k])
+                if keyOrKeyList in self and self[keyOrKeyList] != ignore:
+                    return float(self[keyOrKeyList])
                 return default
 
 
+class CSVDict(_CSVRecord, dict):
+    pass
+
+
+class CSVHeader(object):
+    "The keys shared by all the CSVRows of one file, with the position of each key"
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.index = dict((k, i) for i, k in enumerate(self.keys))
+
+    def __reduce__(self):
+        return (CSVHeader, (self.keys,))
+
+
+class _Missing(object):
+    "The marker for a header key deleted from a CSVRow, which pickles as a reference"
+    __slots__ = ()
+
+    def __reduce__(self):
+        return '_missing'
+
+
+_missing = _Missing()
+
+
+class CSVRow(_CSVRecord):
+    """
+    A compact alternative to CSVDict with the same mapping interface.  The keys live in
+    a CSVHeader shared by all the rows of a file and each row holds only a list of
+    values, so a row costs a small fraction of the memory of a dict.  Keys which are not
+    in the header can still be set, and are kept in a per-row dict created as needed.
+    """
+    __slots__ = ('_header', '_values', '_extra')
+    __hash__ = None
+
+    def __init__(self, header, values, extra=None):
+        assert len(values) == len(header.keys), "CSVRow values do not match its header"
+        self._header = header
+        self._values = values if isinstance(values, types.ListType) else list(values)
+        self._extra = extra
+
+    def __reduce__(self):
+        return (CSVRow, (self._header, self._values, self._extra))
+
+    def __getitem__(self, key):
+        idx = self._header.index.get(key)
+        if idx is not None:
+            val = self._values[idx]
+            if val is not _missing:
+                return val
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        idx = self._header.index.get(key)
+        if idx is not None:
+            self._values[idx] = val
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = val
+
+    def __delitem__(self, key):
+        idx = self._header.index.get(key)
+        if idx is not None:
+            if self._values[idx] is _missing:
+                raise KeyError(key)
+            self._values[idx] = _missing
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        idx = self._header.index.get(key)
+        if idx is not None:
+            return self._values[idx] is not _missing
+        return self._extra is not None and key in self._extra
+
+    has_key = __contains__
+
+    def iteritems(self):
+        for key, val in itertools.izip(self._header.keys, self._values):
+            if val is not _missing:
+                yield key, val
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
+
+    def iterkeys(self):
+        for key, val in self.iteritems():
+            yield key
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for key, val in self.iteritems():
+            yield val
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __len__(self):
+        n = len(self._values) - self._values.count(_missing)
+        return n + len(self._extra) if self._extra else n
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            val = self[key]
+            del self[key]
+            return val
+        if args:
+            return args[0]
+        raise KeyError(key)
+
+    def update(self, *args, **kwargs):
+        for key, val in dict(*args, **kwargs).iteritems():
+            self[key] = val
+
+    def copy(self):
+        return CSVRow(self._header, self._values[:],
+                      None if self._extra is None else self._extra.copy())
+
+    def __eq__(self, other):
+        if isinstance(other, CSVRow):
+            other = dict(other.iteritems())
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        return "CSVRow(%r)" % dict(self.iteritems())
+
+
 def makeSplitRegex(delim):
     """
     This regex should properly handle the following cases:
@@ -94,36 +278,66 @@ def makeSplitRegex(delim):
         return re.compile(rstr)
 
 
-def parseCSVHeader(ifile):
+def makeSplitter(delim):
     """
-    returns just the list of keys from the header of the csv file
-
-    ifile can be any of: an open file, a file name, or a tuple of the form (keys, recs)
-    equivalent to what parseCSV would return (which is returned blindly)
+    Returns an object whose findall() method splits a line exactly as the regex from
+    makeSplitRegex(delim) would.  The compiled csvsplit tokenizer is used when it has been
+    built and handles the delimiter; otherwise this is just the regex.
     """
-    if isinstance(ifile, types.TupleType):
-        if verbose:
-            print("parsing header of preprocessed tuple instead of CSV")
-        return ifile[0]
+    splitRegex = makeSplitRegex(delim)
+    if Splitter is None or delim is None or delim == '\t':
+        return splitRegex
+    return Splitter(delim, splitRegex)
+
 
+def _guessEncoding(ifile, prefix):
+    """
+    Returns an (encoding, errors) tuple suitable for decoding lines of ifile, which
+    is a file name or an open file from which the given prefix lines were read.  The
+    guess is made from the prefix, so the file is never read again; for a file name,
+    util.sniffEncoding may instead supply the result cached for it.
+    """
     if isinstance(ifile, types.StringTypes):
-        name = ifile
+        predictedEncoding, confidence = util.sniffEncoding(ifile, "".join(prefix))
     else:
-        name = ifile.name
+        predictedEncoding, confidence = util.guessEncoding("".join(prefix))
+    # A pure-ASCII prefix says nothing about the rest of the file, so widen it to utf-8
+    if predictedEncoding in [None, "ascii", "utf8", "utf-8"]:
+        predictedEncoding = "utf-8-sig"
+    if confidence >= 0.9:
+        return predictedEncoding, 'strict'
+    else:
+        return predictedEncoding, 'replace'
 
-    if verbose:
-        print(("parsing header of %s" % name))
+
+def _decodeLine(line, encoding, errors):
+    if isinstance(line, types.UnicodeType):
+        return line
+    try:
+        return line.decode(encoding, errors)
+    except UnicodeDecodeError:
+        # This line disagrees with the encoding guessed from the start of the file
+        lineEncoding = chardet.detect(line)['encoding']
+        if lineEncoding is not None:
+            try:
+                return line.decode(lineEncoding)
+            except (UnicodeDecodeError, LookupError):
+                pass
+        return line.decode(encoding, 'replace')
+
+
+def _findDelimiter(lines, complain=False):
+    """
+    Figure out which of the possible delimiters is used by the given lines, the first of
+    which must be the header.  Returns a tuple of that delimiter and its split regex.
+    """
     possibleDelimiters = [";", ",", "\t", None]  # empty string means whitespace-delimited
-    with openByNameOrFile(ifile) as f:
-        lines = f.readlines(20)  # don't bother reading the entire file, just enough to get hints
-    delimFound = 0
-    delimForThisFile = None
     for delim in possibleDelimiters:
         if delim is not None and lines[0].find(delim) < 0:
             if debug:
                 print(("Delim is not <%s> (no occurrences in labels)" % delim))
             continue
-        tryRegex = makeSplitRegex(delim)
+        tryRegex = makeSplitter(delim)
         wordCount = len(tryRegex.findall(lines[0]))
         if wordCount < 3:
             if debug:
@@ -132,21 +346,25 @@ def parseCSVHeader(ifile):
         for line in lines[1:]:
             nwords = len(tryRegex.findall(line))
             if nwords > 0 and nwords != wordCount:
-                if debug:
+                if complain or debug:
                     print(("%d vs. %d: <%s>" % (nwords, wordCount, line)))
+                if debug:
                     print(("Delim is not <%s>\n" % delim))
                 break
         else:
-            delimFound = 1
-            delimForThisFile = delim
-            regexForThisFile = tryRegex
-            break
-    if not delimFound:
-        raise Exception("Cannot find the right delimiter for this CSV input!")
-        # sys.exit("Cannot find the right delimiter for this CSV input!")
-    if debug:
-        print(("delimForThisFile= <%s>" % delimForThisFile))
-    keys = regexForThisFile.findall(lines[0])[:-1]  # skip empty regex match at end
+            if debug:
+                print(("delimForThisFile= <%s>" % delim))
+            return delim, tryRegex
+    raise Exception("Cannot find the right delimiter for this CSV input!")
+    # sys.exit("Cannot find the right delimiter for this CSV input!")
+
+
+def _parseKeys(line, splitRegex):
+    """
+    Returns a tuple containing the list of keys from the header line and a flag which
+    is true if the keys (and so presumably the string values) are quoted.
+    """
+    keys = splitRegex.findall(line)[:-1]  # skip empty regex match at end
     keys = [x.strip() for x in keys]
     stringsAreQuoted = 1
     for key in keys:
@@ -158,20 +376,75 @@ def parseCSVHeader(ifile):
         print(("stringsAreQuoted= %d" % stringsAreQuoted))
     if stringsAreQuoted:
         keys = [x[1:-1] for x in keys]
-    return keys
+    return keys, stringsAreQuoted
 
 
-def parseCSV(ifile):
+def _splitLine(line, lineNum, keys, splitRegex):
     """
-    returns a tuple containing a list of keys and a list of dicts"
+    Split a single data line into its list of words, or return None if the line is blank.
+    """
+    words = splitRegex.findall(line)[:-1]  # skip empty regex match at end
+    words = [x.strip() for x in words]
+    if len(words) == 0:
+        return None
+    if len(words) != len(keys):
+        eS = "Line length error: %d vs %d" % (len(words), len(keys))
+        for i in xrange(len(keys)):
+            eS += "\n%d: <%s> <%s>" % (i, keys[i], words[i])
+        logError(eS)
+        raiseRuntimeError("Line length error parsing CSV at line %d:" % (lineNum))
+        # sys.exit("Line length error parsing CSV at line %d"%(lineNum))
+    return words
+
+
+def _guessValue(word, stringsAreQuoted):
+    """
+    Type-convert a single word of a data line the way parseCSV does: quoted strings lose
+    their quotes, percentages become fractions, and otherwise int or float is tried in
+    turn with the word itself as the fallback.
+    """
+    if (stringsAreQuoted
+        and ((word.startswith('"')
+              and word.endswith('"'))
+             or (word.startswith('"')
+                 and word.endswith('"')))):
+            return word[1:-1]
+    if len(word) > 0:
+        if word[-1] == '%':
+            try:
+                return 0.01*float(word[:-1])
+            except ValueError:
+                return word
+        else:
+            try:
+                return int(word)
+            except ValueError:
+                try:
+                    return float(word)
+                except ValueError:
+                    return word
+    return word
+
+
+def _wordsToRec(words, keys, stringsAreQuoted):
+    """
+    Type-convert the words of a single data line, returning a CSVDict.
+    """
+    return CSVDict(itertools.izip(keys, [_guessValue(word, stringsAreQuoted) for word in words]))
+
+
+def parseCSVHeader(ifile):
+    """
+    returns just the list of keys from the header of the csv file.  Only the first
+    sniffLines lines are read, to guess the encoding and delimiter.
 
     ifile can be any of: an open file, a file name, or a tuple of the form (keys, recs)
-    equivalent to what parseCSV would return (which is returned blindly).
+    equivalent to what parseCSV would return (which is returned blindly)
     """
     if isinstance(ifile, types.TupleType):
         if verbose:
-            print("parsing preprocessed tuple instead of CSV")
-        return ifile
+            print("parsing header of preprocessed tuple instead of CSV")
+        return ifile[0]
 
     if isinstance(ifile, types.StringTypes):
         name = ifile
@@ -179,169 +452,557 @@ def parseCSV(ifile):
         name = ifile.name
 
     if verbose:
-        print(("parsing %s" % name))
-    lineList = []
-    possibleDelimiters = [";", ",", "\t", None]  # empty string means whitespace-delimited
+        print(("parsing header of %s" % name))
+    words = _iterWords(ifile, complain=False)
+    keys, stringsAreQuoted = next(words)  # @UnusedVariable
+    words.close()
+    return keys
+
+
+def _projection(keys, usecols, fileName=None):
+    """
+    Returns the indices in keys of the columns named in usecols, in the order of keys.
+    """
+    missing = [col for col in usecols if col not in keys]
+    if missing:
+        raiseRuntimeError("Columns %s are missing from %s"
+                          % (", ".join(missing), fileName or "the CSV keys"))
+    usecols = set(usecols)
+    return [i for i, key in enumerate(keys) if key in usecols]
+
+
+def _iterWords(ifile, complain=True):
+    """
+    A generator which yields a (keys, stringsAreQuoted) tuple describing the header of
+    the file, followed by the list of (still untyped) words from each non-blank line.
+    Only the first sniffLines lines are used to guess the encoding and delimiter, and
+    complain says whether lines which do not fit a candidate delimiter get printed.
+    """
     with openByNameOrFile(ifile) as f:
-        lines = f.readlines()  # don't bother reading the entire file, just enough to get hints
-    encodingInfo = chardet.detect("".join(lines))
-    if encodingInfo['confidence'] >= 0.9:
-        predictedEncoding = encodingInfo['encoding']
-        if predictedEncoding == "utf8" or predictedEncoding == "utf-8":
-            predictedEncoding = "utf-8-sig"
-        lines = [l.decode(predictedEncoding) for l in lines]
-    else:
-        predictedEncoding = encodingInfo['encoding']
-        if predictedEncoding == "utf8" or predictedEncoding == "utf-8":
-            predictedEncoding = "utf-8-sig"
-        lines = [l.decode(predictedEncoding, 'replace') for l in lines]
-    delimFound = 0
-    delimForThisFile = None
-    for delim in possibleDelimiters:
-        if delim is not None and lines[0].find(delim) < 0:
-            if debug:
-                print(("Delim is not <%s> (no occurrences in labels)" % delim))
-            continue
-        tryRegex = makeSplitRegex(delim)
-        wordCount = len(tryRegex.findall(lines[0]))
-        if wordCount < 3:
-            if debug:
-                print(("Delim is not <%s> (no labels found)\n" % delim))
-            continue
-        for line in lines[1:]:
-            nwords = len(tryRegex.findall(line))
-            if nwords > 0 and nwords != wordCount:
-                print(("%d vs. %d: <%s>" % (nwords, wordCount, line)))
-                if debug:
-                    print(("Delim is not <%s>\n" % delim))
-                break
+        prefix = list(itertools.islice(f, sniffLines))
+        encoding, errors = _guessEncoding(ifile, prefix)
+        lines = [_decodeLine(l, encoding, errors) for l in prefix]
+        delim, splitRegex = _findDelimiter(lines, complain=complain)  # @UnusedVariable
+        keys, stringsAreQuoted = _parseKeys(lines[0], splitRegex)
+        yield keys, stringsAreQuoted
+        remainder = (_decodeLine(l, encoding, errors) for l in f)
+        for lineNum, line in enumerate(itertools.chain(lines[1:], remainder), 1):
+            words = _splitLine(line, lineNum, keys, splitRegex)
+            if words is not None:
+                yield words
+
+
+def iterCSV(ifile, schema=None, compact=False, usecols=None):
+    """
+    A generator version of parseCSV.  The first value yielded is the list of keys from
+    the header line, and each value after that is a CSVDict for one row of the file.
+    Only the first sniffLines lines are used to guess the encoding and delimiter, so rows
+    are produced as the file is read and memory use does not grow with the file size.
+
+    If a CSVSchema is given, the keys yielded are the schema's field names and each row
+    is an instance of the schema's rowType, cast as the line is tokenized.  Otherwise, if
+    compact is true, the rows are CSVRows sharing a single CSVHeader rather than CSVDicts.
+    If usecols is a list of keys, only those columns (in file order) are type converted
+    and included in the keys and rows; a schema already does its own selection.
+
+    ifile can be any of: an open file (or util.MappedLines), a file name, or a tuple of
+    the form (keys, recs) equivalent to what parseCSV would return (the contents of which
+    are yielded blindly, unless a schema or usecols is given).
+    """
+    assert schema is None or usecols is None, "a schema and usecols cannot both be given"
+    if isinstance(ifile, types.TupleType):
+        if verbose:
+            print("iterating over preprocessed tuple instead of CSV")
+        keys, recs = ifile
+        if schema is None and usecols is not None:
+            keys = [keys[i] for i in _projection(keys, usecols)]
+            yield keys
+            for rec in recs:
+                yield CSVDict((key, rec[key]) for key in keys if key in rec)
+        elif schema is None:
+            yield keys
+            for rec in recs:
+                yield rec
         else:
-            delimFound = 1
-            delimForThisFile = delim
-            regexForThisFile = tryRegex
-            break
-    if not delimFound:
-        raise Exception("Cannot find the right delimiter for this CSV input!")
-        # sys.exit("Cannot find the right delimiter for this CSV input!")
-    if debug:
-        print(("delimForThisFile= <%s>" % delimForThisFile))
-    keys = regexForThisFile.findall(lines[0])[:-1]  # skip empty regex match at end
-    keys = [x.strip() for x in keys]
-    stringsAreQuoted = 1
-    for key in keys:
-        if len(key) > 0 \
-                and (not key.startswith('"') or not key.endswith('"')) \
-                and (not key.startswith("'") or not key.endswith("'")):
-            stringsAreQuoted = 0
-    if debug:
-        print(("stringsAreQuoted= %d" % stringsAreQuoted))
+            makeRow = schema._recConverter(keys)
+            yield schema.fields
+            for lineNum, rec in enumerate(recs, 1):
+                yield makeRow(rec, lineNum)
+        return
+
+    if isinstance(ifile, types.StringTypes):
+        name = ifile
+    else:
+        name = ifile.name
+
+    if verbose:
+        print(("parsing %s" % name))
+    words = _iterWords(ifile)
+    keys, stringsAreQuoted = next(words)
+    if usecols is not None:
+        cols = _projection(keys, usecols, name)
+        keys = [keys[i] for i in cols]
+        words = ([wordList[i] for i in cols] for wordList in words)
+    if schema is None and compact:
+        header = CSVHeader(keys)
+        yield keys
+        for wordList in words:
+            yield CSVRow(header, [_guessValue(word, stringsAreQuoted) for word in wordList])
+    elif schema is None:
+        yield keys
+        for wordList in words:
+            yield _wordsToRec(wordList, keys, stringsAreQuoted)
+    else:
+        makeRow = schema._wordConverter(keys, stringsAreQuoted, name)
+        yield schema.fields
+        for lineNum, wordList in enumerate(words, 1):
+            yield makeRow(wordList, lineNum)
+
+
+def parseCSV(ifile, schema=None, compact=False, usecols=None):
+    """
+    returns a tuple containing a list of keys and a list of dicts"
+
+    If a CSVSchema is given, the keys are the schema's field names and the rows are
+    instances of the schema's rowType rather than dicts.  Otherwise, if compact is true,
+    the rows are CSVRows, which behave like CSVDicts but use much less memory.  If
+    usecols is a list of keys, only those columns are read into the rows.
+
+    ifile can be any of: an open file (or util.MappedLines), a file name, or a tuple of
+    the form (keys, recs) equivalent to what parseCSV would return (which is returned
+    blindly unless a schema or usecols is given).
+    """
+    if isinstance(ifile, types.TupleType) and schema is None and usecols is None:
+        if verbose:
+            print("parsing preprocessed tuple instead of CSV")
+        return ifile
+
+    rows = iterCSV(ifile, schema, compact, usecols)
+    keys = next(rows)
+    return (keys, list(rows))
+
+
+_CSV_CACHE_VERSION = 1
+
+
+def _csvCachePath(fname, cacheDir):
+    path = os.path.abspath(fname)
+    if cacheDir is None:
+        return os.path.join(os.path.dirname(path), '.%s.csvcache' % os.path.basename(path))
+    if isinstance(path, types.UnicodeType):
+        path = path.encode('utf-8')
+    return os.path.join(cacheDir, '%s.csvcache' % hashlib.sha1(path).hexdigest())
+
+
+def _readCSVCache(cachePath, stamp):
+    """
+    Returns the (keys, recs) tuple stored in the cache file, or None if the file is
+    missing, unreadable, or was written for a different version of the source.
+    """
+    try:
+        with open(cachePath, 'rb') as f:
+            unpacker = msgpack.Unpacker(f, use_list=True, raw=False)
+            if next(unpacker) != [_CSV_CACHE_VERSION] + list(stamp):
+                return None
+            keys = next(unpacker)
+            return (keys, [CSVDict(zip(keys, row)) for row in unpacker])
+    except (IOError, OSError, StopIteration, ValueError, msgpack.UnpackException):
+        return None
+
+
+def _writeCSVCache(cachePath, stamp, keys, recs):
+    """
+    Write the cache file by way of a temporary file and a rename, so that a concurrent
+    reader never sees a partial cache.  Failure to write the cache is not an error.
+    """
+    packer = msgpack.Packer(use_bin_type=True)
+    tmpPath = None
+    try:
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(cachePath), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(packer.pack([_CSV_CACHE_VERSION] + list(stamp)))
+            f.write(packer.pack(keys))
+            for rec in recs:
+                f.write(packer.pack([rec[k] for k in keys]))
+        os.rename(tmpPath, cachePath)
+    except (IOError, OSError, TypeError, ValueError, OverflowError) as e:
+        if debug:
+            print(("not caching parsed CSV in %s: %s" % (cachePath, e)))
+        if tmpPath is not None and os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+def parseCSVCached(fname, cacheDir=None):
+    """
+    returns the same (keys, recs) tuple as parseCSV(fname), but keeps a compact msgpack
+    copy of the parsed records.  Later calls load that copy instead of re-tokenizing and
+    re-converting the file, as long as the file's modification time and size have not
+    changed; otherwise the file is parsed again and the copy replaced.
+
+    The copy is written beside the file as .<name>.csvcache, or in cacheDir if that is
+    given.  fname must be the name of a file (or a tuple of the form (keys, recs), which
+    is returned blindly).
+    """
+    if isinstance(fname, types.TupleType):
+        if verbose:
+            print("parsing preprocessed tuple instead of CSV")
+        return fname
+
+    st = os.stat(fname)
+    stamp = (st.st_mtime, st.st_size)
+    cachePath = _csvCachePath(fname, cacheDir)
+    result = _readCSVCache(cachePath, stamp)
+    if result is not None:
+        if verbose:
+            print(("loaded %s from cache %s" % (fname, cachePath)))
+        return result
+    keys, recs = parseCSV(fname)
+    _writeCSVCache(cachePath, stamp, keys, recs)
+    return (keys, recs)
+
+
+def _parseCSVChunk(args):
+    """
+    Worker for parseCSVParallel: parse the lines between two byte offsets of a file.
+    """
+    fname, start, end, encoding, errors, delim, keys, stringsAreQuoted = args
+    splitRegex = makeSplitter(delim)
+    recs = []
+    try:
+        # The workers all map the same file, so they share one copy in the page cache
+        with util.MappedLines(fname, start, end) as lines:
+            for lineNum, line in enumerate(lines, 1):
+                words = _splitLine(_decodeLine(line, encoding, errors), lineNum, keys,
+                                   splitRegex)
+                if words is not None:
+                    recs.append(_wordsToRec(words, keys, stringsAreQuoted))
+    except RuntimeError as e:
+        raise RuntimeError("%s (lines counted from byte %d of %s)" % (e, start, fname))
+    return recs
+
+
+_bareCR = re.compile(b'\r(?!\n)')
+
+
+def _hasBareCR(fname):
+    """
+    True if the named file has a '\\r' line ending not followed by '\\n', which the line
+    splitting of parseCSVParallel would not see as the end of a line.
+    """
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _bareCR.search(mm) is not None
+        finally:
+            mm.close()
+
+
+def parseCSVParallel(fname, workers=None, minChunkBytes=1 << 20):
+    """
+    returns the same (keys, recs) tuple as parseCSV, but the data lines are split into
+    chunks which are parsed by a pool of worker processes.  Chunk boundaries always fall
+    at the start of a line; since parseCSV treats every line as one record, this gives
+    exactly the records (and type conversions) parseCSV would.
+
+    fname must be the name of a file (or a tuple of the form (keys, recs), which is
+    returned blindly).  workers defaults to the number of CPUs, and chunks are never
+    made smaller than minChunkBytes.  Compressed files are simply handed to parseCSV,
+    as are files with any old Mac style '\\r' line endings: the chunks are split at
+    '\\n' ('\\r\\n' endings are fine), while parseCSV reads in universal newline mode.
+    """
+    if isinstance(fname, types.TupleType):
+        if verbose:
+            print("parsing preprocessed tuple instead of CSV")
+        return fname
+
+    if util.streamFormat(fname) is not None:
+        # compressed data cannot be split at byte offsets, so it is parsed serially
+        return parseCSV(fname)
+    if _hasBareCR(fname):
+        if verbose:
+            print(("%s has '\\r' line endings, so it is parsed serially" % fname))
+        return parseCSV(fname)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if verbose:
+        print(("parsing %s with %d workers" % (fname, workers)))
+    with open(fname, 'rb') as f:
+        prefix = list(itertools.islice(f, sniffLines))
+        dataStart = len(prefix[0])
+        fileSize = os.fstat(f.fileno()).st_size
+        encoding, errors = _guessEncoding(fname, prefix)
+        lines = [_decodeLine(l, encoding, errors) for l in prefix]
+        delim, splitRegex = _findDelimiter(lines, complain=True)
+        keys, stringsAreQuoted = _parseKeys(lines[0], splitRegex)
+
+        nChunks = max(1, min(4 * workers, (fileSize - dataStart) // minChunkBytes))
+        offsets = [dataStart]
+        for i in xrange(1, nChunks):
+            f.seek(dataStart + (i * (fileSize - dataStart)) // nChunks)
+            f.readline()  # advance to the start of the next line
+            offsets.append(max(offsets[-1], f.tell()))
+        offsets.append(fileSize)
+
+    args = [(fname, start, end, encoding, errors, delim, keys, stringsAreQuoted)
+            for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+    if workers <= 1 or len(args) <= 1:
+        chunks = [_parseCSVChunk(a) for a in args]
+    else:
+        pool = multiprocessing.Pool(min(workers, len(args)))
+        try:
+            chunks = pool.map(_parseCSVChunk, args)
+        finally:
+            pool.close()
+            pool.join()
+    return (keys, list(itertools.chain.from_iterable(chunks)))
+
+
+def _columnToMaskedArray(words, stringsAreQuoted, naValues):
+    """
+    Convert a numpy unicode array of the raw words of one column to a masked array,
+    choosing a single dtype for the whole column.  Empty and NA cells are masked.
+    """
     if stringsAreQuoted:
-        keys = [x[1:-1] for x in keys]
-    lines = lines[1:]
-    lineNum = 1
-    for line in lines:
-        words = regexForThisFile.findall(line)[:-1]  # skip empty regex match at end
-        words = [x.strip() for x in words]
-        if len(words) > 0:
-            dct = CSVDict()
-            if len(words) != len(keys):
-                eS = "Line length error: %d vs %d" % (len(words), len(keys))
-                for i in xrange(len(keys)):
-                    eS += "\n%d: <%s> <%s>" % (i, keys[i], words[i])
-                logError(eS)
-                raiseRuntimeError("Line length error parsing CSV at line %d:" % (lineNum))
-                # sys.exit("Line length error parsing CSV at line %d"%(lineNum))
-            for i in xrange(len(keys)):
-                if (stringsAreQuoted
-                    and ((words[i].startswith('"')
-                          and words[i].endswith('"'))
-                         or (words[i].startswith('"')
-                             and words[i].endswith('"')))):
-                        dct[keys[i]] = words[i][1:-1]
-                else:
-                    if len(words[i]) > 0:
-                        if words[i][-1] == '%':
-                            try:
-                                dct[keys[i]] = 0.01*float(words[i][:-1])
-                            except ValueError:
-                                dct[keys[i]] = words[i]
-                        else:
-                            try:
-                                dct[keys[i]] = int(words[i])
-                            except ValueError:
-                                try:
-                                    dct[keys[i]] = float(words[i])
-                                except ValueError:
-                                    dct[keys[i]] = words[i]
-                    else:
-                        dct[keys[i]] = words[i]
+        quoted = np.char.startswith(words, u'"') & np.char.endswith(words, u'"')
+        if quoted.any():
+            words = words.copy()
+            words[quoted] = [w[1:-1] for w in words[quoted]]
+    else:
+        quoted = np.zeros(len(words), dtype=np.bool_)
+    mask = (words == u'')
+    if naValues:
+        mask |= np.in1d(words, list(naValues))
+    present = words[~mask]
+
+    if not quoted[~mask].any():
+        for dtype in [np.int64, np.float64]:
+            try:
+                data = np.zeros(len(words), dtype=dtype)
+                data[~mask] = present.astype(dtype)
+                return np.ma.MaskedArray(data, mask=mask)
+            except (ValueError, OverflowError):
+                pass
+        if len(present) and np.char.endswith(present, u'%').all():
+            try:
+                data = np.zeros(len(words), dtype=np.float64)
+                data[~mask] = 0.01 * np.char.rstrip(present, u'%').astype(np.float64)
+                return np.ma.MaskedArray(data, mask=mask)
+            except ValueError:
+                pass
+
+    data = words.copy()
+    data[mask] = u''
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def parseCSVColumnar(ifile, naValues=('NA',), chunkRows=65536):
+    """
+    returns an OrderedDict mapping each key of the csv file to a numpy masked array
+    holding that column.  The dtype of each column is int64 if every cell is an integer,
+    float64 if every cell is a number (or every cell is a percentage, which is scaled
+    by 0.01 as in parseCSV), and unicode otherwise.  Empty cells and cells matching
+    any of naValues are masked.
+
+    Rows are gathered chunkRows at a time into compact fixed-width arrays, so no
+    per-cell Python objects outlive their chunk.
+
+    ifile can be either an open file or a file name.
+    """
+    if isinstance(ifile, types.StringTypes):
+        name = ifile
+    else:
+        name = ifile.name
+
+    if verbose:
+        print(("parsing %s into columns" % name))
+    words = _iterWords(ifile)
+    keys, stringsAreQuoted = next(words)
+    chunks = [[] for key in keys]  # @UnusedVariable
+    while True:
+        rows = list(itertools.islice(words, chunkRows))
+        if not rows:
+            break
+        for chunkList, col in zip(chunks, zip(*rows)):
+            chunkList.append(np.array(col, dtype=np.unicode_))
+        del rows
+
+    result = collections.OrderedDict()
+    for key, chunkList in zip(keys, chunks):
+        if chunkList:
+            colWords = np.concatenate(chunkList)
+        else:
+            colWords = np.zeros(0, dtype=np.unicode_)
+        result[key] = _columnToMaskedArray(colWords, stringsAreQuoted, naValues)
+    return result
+
+
+def _columnSortKey(sortColumn):
+    "The case-insensitive ordering writeCSV uses for its sortColumn"
+    return lambda rec: unicode(rec[sortColumn]).lower()
+
+
+def _iterSortRun(f, key, runNum):
+    """
+    Yields (key, runNum, position, rec) for each record pickled into a sorted run file.
+    The run and position numbers keep the merge stable and stop it comparing records.
+    """
+    pos = 0
+    while True:
+        try:
+            rec = pickle.load(f)
+        except EOFError:
+            return
+        yield key(rec), runNum, pos, rec
+        pos += 1
+
+
+def sortedRecs(recs, key, maxInMemory=100000):
+    """
+    A generator which yields the records from the iterable recs in the (stable) order
+    given by the key function.  At most maxInMemory records are held in memory; larger
+    inputs are sorted in runs which are spilled to temporary files and then merged.
+    """
+    recs = iter(recs)
+    run = list(itertools.islice(recs, maxInMemory))
+    run.sort(key=key)
+    if len(run) < maxInMemory:
+        for rec in run:
+            yield rec
+        return
+
+    runFiles = []
+    try:
+        while run:
+            f = tempfile.TemporaryFile()
+            for rec in run:
+                pickle.dump(rec, f, 2)
+            f.seek(0)
+            runFiles.append(f)
+            run = list(itertools.islice(recs, maxInMemory))
+            run.sort(key=key)
+        decorated = [_iterSortRun(f, key, runNum) for runNum, f in enumerate(runFiles)]
+        for tpl in heapq.merge(*decorated):
+            yield tpl[-1]
+    finally:
+        for f in runFiles:
+            f.close()
+
+
+class CSVWriter(object):
+    """
+    Writes records to a CSV file in the same format as writeCSV, but row by row.  Rows
+    are formatted whole and written in batches of bufferRows, so the input to writerows
+    can be any iterable, including a generator.  Use it as a context manager:
+
+        with CSVWriter(ofile, keyList, quoteStrings=True) as w:
+            w.writerows(recGenerator)
+
+    ofile can be an open file or a file name.
+    """
+    def __init__(self, ofile, keyList, delim=",", quoteStrings=False, emptyVal='NA',
+                 bufferRows=1000):
+        self.ofile = ofile
+        self.keyList = keyList
+        self.delim = delim
+        self.quoteStrings = quoteStrings
+        self.emptyVal = emptyVal
+        self.bufferRows = bufferRows
+        self.nRecs = 0
+        self._opener = None
+        self._o = None
+        self._buf = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def open(self):
+        self._opener = openByNameOrFile(self.ofile, 'w')
+        rawO = self._opener.__enter__()
+        self._o = codecs.getwriter(getPreferredOutputEncoding(rawO.encoding))(rawO, 'replace')
+        if self.quoteStrings:
+            self._buf.append(self.delim.join(['"%s"' % key for key in self.keyList]))
+        else:
+            self._buf.append(self.delim.join(["%s" % key for key in self.keyList]))
+        self._buf.append("\n")
+
+    def flush(self):
+        if self._buf:
+            self._o.write(''.join(self._buf))
+            self._buf = []
+
+    def close(self):
+        if self._opener is not None:
+            self.flush()
+            self._opener.__exit__(None, None, None)
+            self._opener = None
+
+    def _formatVal(self, val):
+        if isinstance(val, (types.IntType, types.LongType)):
+            return "%d" % val
+        elif isinstance(val, float):
+            return "%r" % val
+        elif self.quoteStrings:
+            if val.startswith('"') and val.endswith('"'):
+                return '%s' % val
+            else:
+                return '"%s"' % val
+        else:
+            return "%s" % (val,)
+
+    def writerow(self, rD):
+        vals = []
+        for key in self.keyList:
+            try:
+                val = rD[key]
+            except KeyError:
+                val = self.emptyVal
+            vals.append(self._formatVal(val))
+        self._buf.append(self.delim.join(vals))
+        self._buf.append("\n")
+        self.nRecs += 1
+        if len(self._buf) >= 2 * self.bufferRows:
+            self.flush()
 
-            lineList.append(dct)
-        lineNum += 1
-    return (keys, lineList)
+    def writerows(self, recs, sortKey=None, maxInMemory=100000):
+        """
+        Write every record in the iterable recs.  If sortKey is given, the records are
+        first put in that order with sortedRecs (using at most maxInMemory in memory).
+        """
+        if sortKey is not None:
+            recs = sortedRecs(recs, sortKey, maxInMemory)
+        for rD in recs:
+            self.writerow(rD)
 
 
 def writeCSV(ofile, keyList, recDictList, delim=",", quoteStrings=False, sortColumn=None,
              emptyVal='NA'):
     """
     Each element of the input recDictList is a dictionary containing
-    keys from keyList.
-    """
-    with openByNameOrFile(ofile, 'w') as rawO:
-        o = codecs.getwriter(getPreferredOutputEncoding(rawO.encoding))(rawO, 'replace')
-        if quoteStrings:
-            o.write('"%s"' % keyList[0])
-            for key in keyList[1:]:
-                o.write('%s"%s"' % (delim, key))
-        else:
-            o.write("%s" % keyList[0])
-            for key in keyList[1:]:
-                o.write("%s%s" % (delim, key))
-        o.write("\n")
+    keys from keyList.  If sortColumn is given, recDictList is sorted in place on
+    that column (case-insensitively) before writing.  See CSVWriter for a version
+    which accepts any iterable of records.
+    """
+    with CSVWriter(ofile, keyList, delim=delim, quoteStrings=quoteStrings,
+                   emptyVal=emptyVal) as w:
         if sortColumn is not None:
             if sortColumn not in keyList:
                 print ("Warning: sortColumn specified in  writeCSV is not a valid column,"
                        " no sorting will be performed.")
-            else:
-                recDictList.sort(lambda x, y: cmp(unicode(x[sortColumn]).lower(),
-                                                  unicode(y[sortColumn]).lower()))
-
-        for rD in recDictList:
-            try:
-                val = rD[keyList[0]]
-            except KeyError:
-                val = emptyVal
-            if isinstance(val, (types.IntType, types.LongType)):
-                o.write("%d" % val)
-            elif isinstance(val, float):
-                o.write("%r" % val)
-            elif quoteStrings:
-                if val.startswith('"') and val.endswith('"'):
-                    o.write('%s' % val)
-                else:
-                    o.write('"%s"' % val)
-            else:
-                o.write("%s" % val)
-            for key in keyList[1:]:
-                try:
-                    val = rD[key]
-                except KeyError:
-                    val = emptyVal
-                if isinstance(val, (types.IntType, types.LongType)):
-                    o.write("%s%d" % (delim, val))
-                elif isinstance(val, float):
-                    o.write("%s%r" % (delim, val))
-                elif quoteStrings:
-                    if val.startswith('"') and val.endswith('"'):
-                        o.write('%s%s' % (delim, val))
-                    else:
-                        o.write('%s"%s"' % (delim, val))
-                else:
-                    o.write("%s%s" % (delim, val))
-            o.write("\n")
+            elif len(recDictList) > 1:
+                # a single record is never compared, so it need not have the column
+                recDictList.sort(key=_columnSortKey(sortColumn))
+        w.writerows(recDictList)
     if debug:
         print(("Wrote %d recs, delim=<%s>, quoteStrings= %s" %
-               (len(recDictList), delim, quoteStrings)))
+               (w.nRecs, delim, quoteStrings)))
 
 
 class castTypes:
@@ -374,8 +1035,7 @@ class castTypes:
                         dVal = val.decode(i)
 
                         break
-                    except Exception as e:
-                        print(("%s" % str(e)))
+                    except Exception:
                         pass
                 try:
                     ret = dVal
@@ -577,3 +1237,396 @@ def castColumn(recs, key, castList, fileName=None):
                 break
         else:
             raise castFail(val, key, line, fileName)
+
+
+class CSVColumn(object):
+    """
+    One column of a CSVSchema.  castList is tried in order on each cell of the column,
+    as castColumn would.  If the column is missing from a file that is an error if
+    required is true; otherwise every row gets default for it.  field is the name of the
+    column in the row records, and defaults to the column name itself.
+    """
+    def __init__(self, name, castList, required=True, default=None, field=None):
+        if isinstance(castList, types.FunctionType):
+            castList = [castList]
+        self.name = name
+        self.castList = castList
+        self.required = required
+        self.default = default
+        self.field = name if field is None else field
+
+    def __repr__(self):
+        return "CSVColumn(%r, required=%r, default=%r, field=%r)" % (self.name, self.required,
+                                                                   self.default, self.field)
+
+
+_unguessed = object()
+
+
+def _castWord(word, castList, stringsAreQuoted):
+    """
+    Apply castList to a single word of a data line, returning a (status, value) tuple.
+    Each cast is tried first on the text of the word and then, only if it rejects that,
+    on the value parseCSV would have produced for it.
+    """
+    if stringsAreQuoted and word.startswith('"') and word.endswith('"'):
+        text = guess = word[1:-1]
+    else:
+        text = word
+        guess = _unguessed
+    for cast in castList:
+        status, out = cast(text)
+        if status:
+            return status, out
+        if guess is _unguessed:
+            guess = _guessValue(word, stringsAreQuoted)
+        if guess is not text:
+            status, out = cast(guess)
+            if status:
+                return status, out
+    return False, text
+
+
+class CSVSchema(object):
+    """
+    A declarative description of the typed columns of a CSV file.  Given to parseCSV or
+    iterCSV, the casts are applied to each line as it is tokenized, in a single pass, and
+    the rows come out as instances of rowType: a phacollections.namedtuple with one field
+    per schema column, in schema order.  Columns of the file not in the schema are dropped.
+
+    Since the casts see the text of each cell before any guessed type, a cell is normally
+    converted just once.  The one visible difference from castColumn is that numbers cast
+    with STRING keep their original spelling (u'1e3' rather than u'1000.0').
+
+    columns is a list of CSVColumns or of tuples of CSVColumn arguments.  typename names
+    the row type, and must be unique since namedtuple registers it for pickling.
+    """
+    def __init__(self, typename, columns):
+        self.columns = [col if isinstance(col, CSVColumn) else CSVColumn(*col)
+                        for col in columns]
+        self.fields = [col.field for col in self.columns]
+        self.rowType = phacollections.namedtuple(typename, self.fields)
+
+    def _plan(self, keys, fileName=None):
+        "pair each schema column with its index in keys, or None if it is absent"
+        plan = []
+        for col in self.columns:
+            if col.name in keys:
+                plan.append((keys.index(col.name), col))
+            elif col.required:
+                raiseRuntimeError("Required column %s is missing from %s"
+                                  % (col.name, fileName or "the CSV keys"))
+            else:
+                plan.append((None, col))
+        return plan
+
+    def _wordConverter(self, keys, stringsAreQuoted, fileName=None):
+        "returns a function converting the word list of a line to a row"
+        plan = self._plan(keys, fileName)
+        make = self.rowType._make
+
+        def makeRow(words, lineNum):
+            vals = []
+            for idx, col in plan:
+                if idx is None:
+                    vals.append(col.default)
+                else:
+                    status, out = _castWord(words[idx], col.castList, stringsAreQuoted)
+                    if not status:
+                        raise castFail(out, col.name, lineNum, fileName)
+                    vals.append(out)
+            return make(vals)
+        return makeRow
+
+    def _recConverter(self, keys):
+        "returns a function converting an already parsed dict to a row"
+        plan = self._plan(keys)
+        make = self.rowType._make
+
+        def makeRow(rec, lineNum):
+            vals = []
+            for idx, col in plan:
+                if idx is None:
+                    vals.append(col.default)
+                else:
+                    val = rec.get(col.name)
+                    for cast in col.castList:
+                        status, out = cast(val)
+                        if status:
+                            vals.append(out)
+                            break
+                    else:
+                        raise castFail(val, col.name, lineNum)
+            return make(vals)
+        return makeRow
+
+
+# Python type codes used to partition a column for the batch casts
+_T_NONE, _T_INT, _T_FLOAT, _T_STR, _T_OTHER = range(5)
+_typeCodes = {types.NoneType: _T_NONE,
+              types.BooleanType: _T_INT,
+              types.IntType: _T_INT,
+              types.LongType: _T_INT,
+              types.FloatType: _T_FLOAT,
+              types.StringType: _T_STR,
+              types.UnicodeType: _T_STR}
+
+
+def _undecided(n):
+    "returns the (decided, ok, out) triple of a batch cast which has decided nothing"
+    return np.zeros(n, dtype=np.bool_), np.zeros(n, dtype=np.bool_), np.empty(n, dtype=object)
+
+
+def _parseNumberWords(words, dtype):
+    """
+    Parse a list of strings which each hold exactly one decimal number (with no blanks)
+    to an array of dtype, np.int64 or np.float64, in a single pass of numpy's text parser.
+    Returns None unless every word gives the same value int() or float() would.
+
+    The words are joined with ',', which numpy must find straight after each number it
+    reads, so a word is only accepted if the number read from it spans the whole word.
+    Int words are also checked to be an optional sign and at most 18 digits, since numpy
+    reads a lone sign as 0 and clips values which overflow.
+    """
+    try:
+        text = ','.join(words)
+        if isinstance(text, types.UnicodeType):
+            text = text.encode('ascii')
+    except UnicodeError:
+        return None
+    isInt = dtype is np.int64
+    if text.translate(None, '0123456789+-,' if isInt else '0123456789+-.eE,'):
+        return None
+    if text.count(',') != len(words) - 1:
+        return None  # a word with a comma of its own
+    if isInt:
+        digits = (',' + text).replace(',-', ',').replace(',+', ',')
+        if '-' in digits or '+' in digits or ',,' in digits or digits.endswith(','):
+            return None
+        commas = np.flatnonzero(np.frombuffer(digits, dtype=np.uint8) == ord(','))
+        if np.diff(np.append(commas, len(digits))).max() > 19:
+            return None
+    # the trailing word makes numpy find a ',' after the last real one too
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        arr = np.fromstring(text + ',0', dtype=dtype, sep=',')
+    if len(arr) != len(words) + 1:
+        return None
+    return arr[:-1]
+
+
+def _batchConvert(vals, codes, codeList, dtype):
+    """
+    Convert the cells of vals with a type code in codeList to the given numpy dtype in
+    one step, returning their indices and the converted array.  If any one of them will
+    not convert (or overflows) the indices are returned with None in place of the array.
+    """
+    idx = np.flatnonzero(np.in1d(codes, codeList))
+    if len(idx) == 0:
+        return idx, np.zeros(0, dtype=dtype)
+    cells = vals[idx].tolist()
+    if codeList == [_T_STR]:
+        return idx, _parseNumberWords(cells, dtype)
+    try:
+        return idx, np.array(cells, dtype=dtype)
+    except (ValueError, TypeError, OverflowError):
+        return idx, None
+
+
+def _batchInt(vals, codes):
+    decided, ok, out = _undecided(len(vals))
+    decided[codes == _T_NONE] = True
+    for codeList in [[_T_INT], [_T_STR]]:
+        idx, arr = _batchConvert(vals, codes, codeList, np.int64)
+        if arr is not None:
+            decided[idx] = ok[idx] = True
+            out[idx] = arr
+    idx, arr = _batchConvert(vals, codes, [_T_FLOAT], np.float64)
+    if arr is not None:
+        # int() of nan or inf fails; huge values would overflow int64, so leave them
+        finite = np.isfinite(arr)
+        inRange = np.zeros(len(arr), dtype=np.bool_)
+        inRange[finite] = np.abs(arr[finite]) < 2.0 ** 63
+        decided[idx[~finite]] = True
+        decided[idx[inRange]] = ok[idx[inRange]] = True
+        out[idx[inRange]] = np.trunc(arr[inRange]).astype(np.int64)
+    return decided, ok, out
+
+
+def _batchFloat(vals, codes):
+    decided, ok, out = _undecided(len(vals))
+    decided[codes == _T_NONE] = True
+    for codeList in [[_T_INT, _T_FLOAT], [_T_STR]]:
+        idx, arr = _batchConvert(vals, codes, codeList, np.float64)
+        if arr is not None:
+            decided[idx] = ok[idx] = True
+            out[idx] = arr
+    return decided, ok, out
+
+
+def _batchIntAtLeast(minVal):
+    def batchCast(vals, codes):
+        decided, ok, out = _batchInt(vals, codes)
+        if ok.any():
+            ok[ok] = np.array(out[ok].tolist()) >= minVal
+        return decided, ok, out
+    return batchCast
+
+
+def _batchEmpty(vals, codes):
+    return np.ones(len(vals), dtype=np.bool_), codes == _T_NONE, np.empty(len(vals), dtype=object)
+
+
+def _batchNA(vals, codes):
+    decided, ok, out = _undecided(len(vals))
+    decided[codes != _T_OTHER] = True
+    ok[codes == _T_STR] = (vals[codes == _T_STR] == "NA")
+    out[ok] = vals[ok]
+    return decided, ok, out
+
+
+def _batchEmptyIs(emptyVal):
+    def batchCast(vals, codes):
+        decided, ok, out = _undecided(len(vals))
+        decided[codes != _T_OTHER] = True
+        ok[codes == _T_NONE] = True
+        ok[codes == _T_STR] = (vals[codes == _T_STR] == "")
+        out[ok] = [emptyVal] * np.count_nonzero(ok)
+        return decided, ok, out
+    return batchCast
+
+
+def _batchBoolean(vals, codes):
+    decided, ok, out = _undecided(len(vals))
+    decided[codes == _T_NONE] = ok[codes == _T_NONE] = True
+    out[codes == _T_NONE] = 0
+    idx, arr = _batchConvert(vals, codes, [_T_INT, _T_FLOAT], np.float64)
+    if arr is not None:
+        decided[idx] = ok[idx] = True
+        out[idx] = (arr != 0).astype(np.int64)
+    idx = np.flatnonzero(codes == _T_STR)
+    if len(idx):
+        try:
+            lower = np.char.lower(np.array(vals[idx].tolist(), dtype=np.unicode_))
+        except UnicodeError:
+            return decided, ok, out
+        for words, result in [((u't', u'true'), 1), ((u'f', u'false'), 0)]:
+            sel = idx[np.in1d(lower, words)]
+            decided[sel] = ok[sel] = True
+            out[sel] = result
+        rest = idx[~decided[idx]]
+        if len(rest):
+            arr = _parseNumberWords(vals[rest].tolist(), np.float64)
+            if arr is not None:
+                decided[rest] = ok[rest] = True
+                out[rest] = (arr != 0).astype(np.int64)
+            # otherwise leave these to CastBoolean itself
+    return decided, ok, out
+
+
+def _batchString(vals, codes):
+    decided, ok, out = _undecided(len(vals))
+    decided[codes == _T_NONE] = True
+    idx = np.flatnonzero(codes == _T_STR)
+    if len(idx):
+        # unicode passes through unchanged; byte strings need CastString's decoding
+        sel = idx[np.array([type(v) is types.UnicodeType for v in vals[idx].tolist()],
+                           dtype=np.bool_)]
+        decided[sel] = ok[sel] = True
+        out[sel] = vals[sel]
+    return decided, ok, out
+
+
+# The casts with a whole-column implementation; anything else is cast cell by cell
+_batchCasts = {castTypes.CastInt: _batchInt,
+               castTypes.CastFloat: _batchFloat,
+               castTypes.CastNonnegativeInt: _batchIntAtLeast(0),
+               castTypes.CastPositiveInt: _batchIntAtLeast(1),
+               castTypes.CastEmpty: _batchEmpty,
+               castTypes.CastNA: _batchNA,
+               castTypes.CastEmptyIsNullString: _batchEmptyIs(unicode("")),
+               castTypes.CastEmptyIsZero: _batchEmptyIs(0),
+               castTypes.CastEmptyIsNone: _batchEmptyIs(None),
+               castTypes.CastBoolean: _batchBoolean,
+               castTypes.CastString: _batchString}
+
+
+def _castHints(rec):
+    hints = {}
+    if hasattr(rec, 'predictedEncoding') and rec.predictedEncoding is not None:
+        hints['predictedEncoding'] = rec.predictedEncoding
+    return hints
+
+
+def castColumnBatch(recs, key, castList, fileName=None):
+    """
+    Cast all entries in a column to a specific (set of) type(s), with the same result
+    for each cell as castColumn.  Each cast in castList is applied to all the cells not
+    yet cast at once, using numpy conversions where possible and calling the cast on
+    individual cells only for those the batch version cannot decide.
+
+    Rather than raising castFail at the first failure, this casts every cell it can
+    and returns a list of the castFail exceptions castColumn would have raised for the
+    cells which failed every cast, in line order (their line attribute counts from 1).
+    Those cells are left unchanged.
+    """
+    if isinstance(castList, types.FunctionType):
+        castList = [castList]
+    if not isinstance(recs, types.ListType):
+        recs = list(recs)
+
+    cells = [rec[key] if key in rec else None for rec in recs]
+    nCells = len(cells)
+    vals = np.empty(nCells, dtype=object)
+    try:
+        vals[:] = cells
+    except ValueError:
+        # numpy tried to treat sequence-valued cells as another dimension
+        for i, v in enumerate(cells):
+            vals[i] = v
+    cellTypes = map(type, cells)
+    del cells
+    typeSet = set(cellTypes)
+    typeCode = _typeCodes.get
+    if len(typeSet) == 1:
+        codes = np.full(nCells, typeCode(typeSet.pop(), _T_OTHER), dtype=np.int8)
+    else:
+        codes = np.array([typeCode(tp, _T_OTHER) for tp in cellTypes], dtype=np.int8)
+    del cellTypes
+
+    results = None
+    pending = np.arange(nCells)
+    for cast in castList:
+        if len(pending) == 0:
+            break
+        if results is None:
+            # nothing is cast yet, so skip the object array copies
+            pendingVals, pendingCodes = vals, codes
+        else:
+            pendingVals, pendingCodes = vals[pending], codes[pending]
+        if cast in _batchCasts:
+            decided, ok, out = _batchCasts[cast](pendingVals, pendingCodes)
+        else:
+            decided, ok, out = _undecided(len(pending))
+        undecided = np.flatnonzero(~decided).tolist()
+        if undecided:
+            pendingList = pending.tolist()
+            pendingVals = pendingVals.tolist()
+            for j in undecided:
+                ok[j], out[j] = cast(pendingVals[j], **_castHints(recs[pendingList[j]]))
+        if results is None:
+            results = out
+        else:
+            results[pending[ok]] = out[ok]
+        pending = pending[~ok]
+
+    if len(pending) == 0:
+        if nCells:
+            for rec, val in itertools.izip(recs, results.tolist()):
+                rec[key] = val
+    else:
+        castOK = np.ones(nCells, dtype=np.bool_)
+        castOK[pending] = False
+        for i in np.flatnonzero(castOK).tolist():
+            recs[i][key] = results[i]
+    return [castFail(vals[i], key, i + 1, fileName) for i in pending.tolist()]
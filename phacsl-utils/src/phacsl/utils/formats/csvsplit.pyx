@@ -0,0 +1,73 @@
+#cython: boundscheck=False, wraparound=False
+
+# NOTE: Splitter.findall() reproduces the result of
+# NOTE: csv_tools.makeSplitRegex(delim).findall(line) for single character,
+# NOTE: non-whitespace delimiters, without the regex engine's backtracking.
+# NOTE: Byte strings are handed to the regex unchanged.
+
+cdef inline bint _isspace(Py_UCS4 c):
+    # The split regexes are compiled without re.UNICODE, so \s is ASCII whitespace
+    return c == u' ' or c == u'\t' or c == u'\n' or c == u'\r' or c == u'\f' or c == u'\v'
+
+
+cdef class Splitter:
+
+    cdef:
+        Py_UCS4 delim
+        object regex
+
+    def __cinit__(self, delim, regex):
+        if not isinstance(delim, unicode):
+            delim = unicode(delim)
+        if len(delim) != 1 or _isspace(delim[0]):
+            raise ValueError('Splitter only handles single character, non-whitespace delimiters')
+        self.delim = delim[0]
+        self.regex = regex
+
+    def findall(self, text):
+        if not isinstance(text, unicode):
+            return self.regex.findall(text)
+        return self.split(text)
+
+    cdef list split(self, unicode text):
+        cdef:
+            list words = []
+            Py_ssize_t n = len(text)
+            Py_ssize_t pos = 0
+            Py_ssize_t start, close, after, end
+            Py_UCS4 quote
+        while pos <= n:
+            start = pos
+            while start < n and _isspace(text[start]):
+                start += 1
+
+            # A quoted string counts only if a delimiter or the end of line follows it
+            if start < n and (text[start] == u'"' or text[start] == u"'"):
+                quote = text[start]
+                close = start + 1
+                while close < n and text[close] != quote:
+                    close += 1
+                if close < n:
+                    after = close + 1
+                    while after < n and _isspace(text[after]):
+                        after += 1
+                    if after == n or text[after] == self.delim:
+                        words.append(text[start:close + 1])
+                        pos = after + 1 if after < n else n
+                        if after == n:
+                            # the regex then produces one final empty match at the end
+                            words.append(u'')
+                            break
+                        continue
+
+            # Otherwise take everything up to the next delimiter
+            end = start
+            while end < n and text[end] != self.delim:
+                end += 1
+            words.append(text[start:end])
+            if end == n:
+                if pos < n:
+                    words.append(u'')
+                break
+            pos = end + 1
+        return words
@@ -16,11 +16,17 @@
 #                                                                                 #
 ###################################################################################
 
+import os
 import sys
+import codecs
 import re
 import types
-import chardet
-import codecs
+import tempfile
+import itertools
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from ..misc import util
 
 
 class TokenizerException(Exception):
@@ -31,6 +37,66 @@ class ParserException(Exception):
     pass
 
 
+_valueTokens = frozenset(['integer', 'float', 'string', 'identifier'])
+
+# parseMany's results, by (absolute path, encoding), with the (mtime, size) they were read at.
+# Only the parseCacheEntries most recently used are kept.
+parseCacheEntries = 4096
+_parseCache = collections.OrderedDict()
+
+
+def _copyResult(result):
+    "a copy of a parse result which shares nothing mutable with the original"
+    return dict((k, list(v) if isinstance(v, types.ListType) else v)
+                for k, v in result.iteritems())
+
+
+def _kvpValue(v):
+    "the text of a single KVP value, quoted if it is a string"
+    if isinstance(v, types.StringTypes):
+        if '"' in v:
+            return "'%s'" % v  # preserve the quoted substring in v
+        else:
+            return '"%s"' % v
+    else:
+        return '%s' % v
+
+
+def _kvpLine(k, v):
+    "the line of KVP text, newline included, setting key k to value v"
+    if isinstance(v, types.ListType):
+        return '%s = %s\n' % (k, ','.join([_kvpValue(e) for e in v]))
+    return '%s = %s\n' % (k, _kvpValue(v))
+
+
+def _kvpText(items):
+    "the KVP text for a sequence of (key, value) pairs, built in one piece"
+    return ''.join([_kvpLine(k, v) for k, v in items])
+
+
+def _commentStart(text):
+    "where the comment at the end of a line of KVP text (and the blanks before it) starts, or None"
+    for m in iter(KVPParser.fastTokenRe.scanner(text).match, None):
+        if m.lastgroup == 'comment':
+            return m.start()
+    return None
+
+
+def _encoded(text, encoding):
+    "text as bytes in the given encoding; byte strings are passed through as they are"
+    if isinstance(text, unicode):
+        return text.encode(encoding, 'replace')
+    return text
+
+
+def _parseOne(args):
+    "worker for parseMany's pools: (path, encoding, (verbose, debug, fastPath)) -> result"
+    path, encoding, settings = args
+    parser = KVPParser()
+    parser.verbose, parser.debug, parser.fastPath = settings
+    return parser.parse(path, encoding)
+
+
 class KVPParser:
     """
     This class provides services for parsing and generating key value pair files.
@@ -49,6 +115,20 @@ class KVPParser:
     |(?P<trailingblanks>\s+$)
     """,
                          re.VERBOSE)
+    # The same tokens, with no unnamed groups so m.lastgroup names the token type
+    fastTokenRe = re.compile(r"""
+    \s*(?P<comment>\#.*$)
+    |(?P<identifier>[a-zA-Z_][a-zA-Z0-9_]*)
+    |(?P<separator>[,;:])
+    |(?P<equalsign>\s*=\s*)
+    |'(?P<string1>[^']*)'
+    |"(?P<string2>[^"]*)"
+    |(?P<integer>[+-]?[0-9]+(?![0-9.eE]))
+    |(?P<float1>[+-]?[0-9]*\.[0-9]*(?![0-9eE]))
+    |(?P<float2>[+-]?[0-9]*\.[0-9]*[eE][+-]?[0-9]*)
+    |(?P<trailingblanks>\s+$)
+    """,
+                             re.VERBOSE)
     # States for parser FSM
     START = 0
     COMMENT = 1
@@ -61,6 +141,7 @@ class KVPParser:
     def __init__(self):
         self.verbose = 0
         self.debug = 0
+        self.fastPath = True  # the token-by-token FSM is still used when debugging
 
     @staticmethod
     def _tokGen(text, encoding):
@@ -113,7 +194,101 @@ class KVPParser:
             raise TokenizerException('tokenizer stopped at pos %r of %r on <%s>' % (
                 pos, len(text), text))
 
+    @staticmethod
+    def _fastParseKVP(iterator, encoding):
+        """
+        This gives the same result as _innerParseKVP, but each token is found by a single
+        match dispatched on its lastgroup, and the FSM runs inline rather than pulling
+        tokens from a generator.
+        """
+        result = {}
+        START, COMMENT, FAILED, HASKEY, HASEQ, HASVAL, HASLIST = (
+            KVPParser.START, KVPParser.COMMENT, KVPParser.FAILED, KVPParser.HASKEY,
+            KVPParser.HASEQ, KVPParser.HASVAL, KVPParser.HASLIST)
+        scanner = KVPParser.fastTokenRe.scanner
+        for rec in iterator:
+            text = rec.decode(encoding) if encoding is not None else rec
+            key = None
+            val = None
+            valType = None
+            state = START
+            pos = 0
+            for m in iter(scanner(text).match, None):
+                pos = m.end()
+                t = m.lastgroup
+                v = m.group(t)
+                if not v:
+                    continue  # an empty quoted string yields no token
+                if t == 'integer':
+                    v = int(v)
+                elif t == 'float1' or t == 'float2':
+                    t = 'float'
+                    v = float(v)
+                elif t == 'string1' or t == 'string2':
+                    t = 'string'
+                if state == START:
+                    if t == 'identifier':
+                        key = v
+                        state = HASKEY
+                    elif t == 'comment' or t == 'trailingblanks':
+                        state = COMMENT
+                    else:
+                        state = FAILED
+                elif state == HASKEY:
+                    if t == 'equalsign':
+                        state = HASEQ
+                    elif t == 'comment' or t == 'trailingblanks':
+                        state = COMMENT
+                    else:
+                        state = FAILED
+                elif state == HASEQ:
+                    if t in _valueTokens:
+                        val = v
+                        valType = t
+                        state = HASVAL
+                    else:
+                        state = FAILED
+                elif state == HASVAL:
+                    if t == 'separator':
+                        val = [val]
+                        valType = 'list'
+                        state = HASLIST
+                    elif t == 'comment' or t == 'trailingblanks':
+                        state = COMMENT
+                    else:
+                        state = FAILED
+                elif state == HASLIST:
+                    if t in _valueTokens:
+                        val.append(v)
+                    elif t == 'comment' or t == 'trailingblanks':
+                        state = COMMENT
+                    elif t != 'separator':
+                        state = FAILED
+            if pos != len(text):
+                raise ParserException("failed to lex <%s>; %s" % (rec, TokenizerException(
+                    'tokenizer stopped at pos %r of %r on <%s>' % (pos, len(text), text))))
+            if state == FAILED:
+                raise ParserException("Failed to parse <%s>" % rec)
+            if key is not None:
+                if valType == 'identifier':
+                    lowVal = val.lower()
+                    if lowVal == 'none':
+                        result[key] = None
+                    elif lowVal == 'true':
+                        result[key] = True
+                    elif lowVal == 'false':
+                        result[key] = False
+                    else:
+                        result[key] = val
+                elif valType is not None:
+                    result[key] = val
+                else:
+                    result[key] = True
+        return result
+
     def _innerParseKVP(self, iterator, encoding):
+        if self.fastPath and not self.debug:
+            return KVPParser._fastParseKVP(iterator, encoding)
         result = {}
 
         for rec in iterator:
@@ -206,77 +381,111 @@ class KVPParser:
 
     def parse(self, iteratorOrFilename, encoding=None):
         """
-        The input can be an iterator (typically an open file or a list), or a string to
-        be interpreted as a filename.  The optional second parameter is the encoding with which
-        to decode strings to unicode.  The return value of parseKVP is a dict containing
-        keys and their associated values as defined by the file.
+        The input can be an iterator (typically an open file, a util.MappedLines or a
+        list), or a string to be interpreted as a filename.  The optional second parameter
+        is the encoding with which to decode strings to unicode.  The return value of
+        parseKVP is a dict containing keys and their associated values as defined by the
+        file.
         """
         if isinstance(iteratorOrFilename, types.StringTypes):
             if self.verbose:
                 print(("parsing %s" % iteratorOrFilename))
-            if encoding is None:
-                # preparse for encoding
-                with open(iteratorOrFilename, "rU") as f:
-                    lines = f.readlines()
-                    encodingInfo = chardet.detect("".join(lines))
-                    if encodingInfo['confidence'] >= 0.9:
-                        encoding = encodingInfo['encoding']
-                    else:
+            with util.openByNameOrFile(iteratorOrFilename, "rU") as f:
+                lines = f
+                if encoding is None:
+                    # the encoding is guessed from the start of this one read of the file
+                    sample = util.sampleLines(f)
+                    encoding, confidence = util.sniffEncoding(iteratorOrFilename,
+                                                              ''.join(sample))
+                    if confidence < 0.9:
                         encoding = sys.getdefaultencoding()
-
-            with open(iteratorOrFilename, "rU") as f:
-                result = self._innerParseKVP(f, encoding)
+                    lines = itertools.chain(sample, f)
+                result = self._innerParseKVP(lines, encoding)
         else:
             if self.verbose:
                 print("parsing kvp input")
-            if encoding is None:
+            lines = iter(iteratorOrFilename)
+            if encoding is None and isinstance(iteratorOrFilename, util.MappedLines):
+                sample = util.sampleLines(lines)
+                encoding, confidence = util.sniffEncoding(iteratorOrFilename.name,
+                                                          ''.join(sample))
+                if confidence < 0.9:
+                    encoding = sys.getdefaultencoding()
+                lines = itertools.chain(sample, lines)
+            elif encoding is None:
                 encoding = sys.getdefaultencoding()
-            result = self._innerParseKVP(iter(iteratorOrFilename),
-                                         encoding)
+            result = self._innerParseKVP(lines, encoding)
 
         return result
 
-    def _innerWriteKVP(self, ofile, dct):
-        for k, v in dct.items():
-            if isinstance(v, types.StringTypes):
-                if '"' in v:
-                    ofile.write("%s = '%s'\n" % (k, v))  # preserve the quoted substring in v
-                else:
-                    ofile.write('%s = "%s"\n' % (k, v))
-            elif isinstance(v, types.ListType):
-                if len(v) == 0:
-                    ofile.write('%s = \n' % k)
-                else:
-                    vstr = ""
-                    for e in v:
-                        if isinstance(e, types.StringTypes):
-                            if '"' in e:
-                                vstr += "'%s'," % e
-                            else:
-                                vstr += '"%s",' % e
-                        else:
-                            vstr += '%s,' % e
-                    ofile.write('%s = %s\n' % (k, vstr[:-1]))
+    def parseMany(self, paths, workers=None, processes=True, encoding=None):
+        """
+        Parse each of the named files as parse() would, with this parser's settings,
+        returning a dict mapping each path to its result.  The files are read and parsed
+        by a pool of worker processes; workers defaults to the number of CPUs.  Parsing is
+        CPU bound, so a pool of threads (processes=False) only pays off when most of the
+        time goes to waiting on the files, as on a slow network filesystem.
+
+        Results are cached by path and encoding, so a file whose modification time and
+        size are unchanged since an earlier call is not read again.  Each call returns
+        fresh copies of the cached results.  The cache keeps the parseCacheEntries most
+        recently used results.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        results = {}
+        stale = []
+        for path in paths:
+            cacheKey = (os.path.abspath(path), encoding)
+            st = os.stat(path)
+            stamp = (st.st_mtime, st.st_size)
+            if cacheKey in _parseCache and _parseCache[cacheKey][0] == stamp:
+                # move it to the most recently used end
+                _parseCache[cacheKey] = _parseCache.pop(cacheKey)
+                results[path] = _parseCache[cacheKey][1]
+            elif path not in results:
+                results[path] = None
+                stale.append((path, cacheKey, stamp))
+        if self.verbose:
+            print(("parsing %d of %d kvp files" % (len(stale), len(results))))
+
+        if stale:
+            settings = (self.verbose, self.debug, self.fastPath)
+            args = [(path, encoding, settings) for path, cacheKey, stamp in stale]
+            if workers <= 1 or len(stale) == 1:
+                parsed = [self.parse(path, encoding) for path, cacheKey, stamp in stale]
             else:
-                ofile.write('%s = %s\n' % (k, v))
+                pool = (multiprocessing.Pool if processes else ThreadPool)(workers)
+                try:
+                    parsed = pool.map(_parseOne, args)
+                finally:
+                    pool.close()
+                    pool.join()
+            for (path, cacheKey, stamp), result in zip(stale, parsed):
+                _parseCache.pop(cacheKey, None)
+                _parseCache[cacheKey] = (stamp, result)
+                results[path] = result
+        while len(_parseCache) > parseCacheEntries:
+            _parseCache.popitem(last=False)
+
+        return dict((path, _copyResult(result)) for path, result in results.iteritems())
+
+    def _innerWriteKVP(self, ofile, dct):
+        ofile.write(_kvpText(dct.items()))
 
     def writeKVP(self, ofileOrFilename, dct, encoding=None):
         """
         Write the dictionary contents to the given open file as a key-value pair table.
         If ofileOrFilename is a string, that string will be treated as the path to the
-        output file.
+        output file.  The whole table is built as one string and written in one piece.
         """
         if isinstance(ofileOrFilename, types.StringType):
             if self.verbose:
                 print(("writing to %s" % ofileOrFilename))
             with open(ofileOrFilename, "w") as rawFile:
                 if encoding is None:
-                    if hasattr(rawFile, 'encoding'):
-                        encoding = rawFile.encoding
-                    else:
-                        encoding = 'utf8'
-                f = codecs.getwriter(encoding)(rawFile, 'replace')
-                self._innerWriteKVP(f, dct)
+                    encoding = getattr(rawFile, 'encoding', None) or 'utf8'
+                rawFile.write(_kvpText(dct.items()).encode(encoding, 'replace'))
         else:
             if self.verbose:
                 print(("writing to %s" % ofileOrFilename.name))
@@ -285,5 +494,74 @@ class KVPParser:
                     encoding = ofileOrFilename.encoding
             if encoding is None:
                 encoding = 'utf8'
-            f = codecs.getwriter(encoding)(ofileOrFilename, 'replace')
-            self._innerWriteKVP(f, dct)
+            ofileOrFilename.write(_kvpText(dct.items()).encode(encoding, 'replace'))
+
+    def updateKVP(self, fname, changes, encoding=None):
+        """
+        Update the named KVP file so that the keys in the changes dict get their new
+        values, rewriting only the lines of keys whose values actually change.  All other
+        lines, comments included, are kept byte for byte and in order; a changed line keeps
+        its trailing comment and line ending, and keys not yet in the file are appended.
+        The new file replaces the old one by an atomic rename, and nothing is written at
+        all if no value changes.  Returns True if the file was rewritten.
+        """
+        with open(fname, 'rb') as f:
+            lines = f.readlines()
+        if encoding is None:
+            encoding, confidence = util.sniffEncoding(fname, ''.join(util.sampleLines(lines)))
+            if confidence < 0.9:
+                encoding = sys.getdefaultencoding()
+        # new text must not get a BOM of its own; a BOM at the start of the file is kept
+        textEncoding = encoding
+        if codecs.lookup(encoding).name == 'utf-8-sig':
+            textEncoding = 'utf-8'
+
+        pending = dict(changes)
+        changed = False
+        for i, line in enumerate(lines):
+            oldDict = KVPParser._fastParseKVP([line], encoding)
+            if not oldDict:
+                continue
+            key, oldVal = oldDict.items()[0]
+            if key not in changes:
+                continue
+            pending.pop(key, None)
+            newLine = _kvpLine(key, changes[key])
+            if newLine == _kvpLine(key, oldVal):
+                continue
+            body = line.rstrip('\r\n')
+            bom = ''
+            if textEncoding != encoding and body.startswith(codecs.BOM_UTF8):
+                bom = codecs.BOM_UTF8
+            text = body[len(bom):].decode(textEncoding)
+            # the original bytes from the end of the value on (blanks, comment, line ending)
+            start = _commentStart(text)
+            if start is None:
+                tail = line[len(body):]
+            else:
+                tail = line[len(bom) + len(text[:start].encode(textEncoding)):]
+            lines[i] = bom + _encoded(newLine[:-1], textEncoding) + tail
+            changed = True
+        if pending:
+            if lines and not lines[-1].endswith('\n'):
+                lines[-1] += '\n'
+            lines.append(_encoded(_kvpText([(k, changes[k]) for k in changes if k in pending]),
+                                  textEncoding))
+            changed = True
+        if not changed:
+            return False
+
+        if self.verbose:
+            print(("updating %s" % fname))
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                                       suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(''.join(lines))
+            os.chmod(tmpPath, os.stat(fname).st_mode & 0o7777)
+            os.rename(tmpPath, fname)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        return True
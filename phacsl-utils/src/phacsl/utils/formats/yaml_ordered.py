@@ -59,3 +59,8 @@ def install():
 
     yaml.SafeLoader.add_constructor(_YAML_MAP_TAG, _construct_ordered_dict)
     yaml.SafeDumper.add_representer(OrderedDict, _represent_ordered_dict)
+
+    # The LibYAML based classes keep registries of their own
+    if hasattr(yaml, 'CSafeLoader'):
+        yaml.CSafeLoader.add_constructor(_YAML_MAP_TAG, _construct_ordered_dict)
+        yaml.CSafeDumper.add_representer(OrderedDict, _represent_ordered_dict)
@@ -4,10 +4,21 @@ import yaml
 import os.path
 from collections import OrderedDict
 import types
+import tempfile
+import multiprocessing
+try:
+    import cPickle as pickle
+except:
+    import pickle
 
 import yaml_ordered
 yaml_ordered.install()
 
+from ..misc import util
+
+# plain or compressed yaml files
+_yamlSuffixes = ('.yaml',) + tuple('.yaml' + sfx for sfx in util.streamSuffixes)
+
 
 def unicode_safe_constructor(loader, node):
     return node.value
@@ -15,61 +26,285 @@ def unicode_safe_constructor(loader, node):
 yaml.SafeLoader.add_constructor("tag:yaml.org,2002:python/unicode",
                                 unicode_safe_constructor)
 
+# Use the LibYAML parser when PyYAML was built with it; it is many times faster
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+if SafeLoader is not yaml.SafeLoader:
+    SafeLoader.add_constructor("tag:yaml.org,2002:python/unicode",
+                               unicode_safe_constructor)
 
-def parse_all(dirName):
-    recs = []
+
+def load_one(fileName):
+    with util.openStream(fileName, 'r') as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+def _yaml_names(dirName):
+    return [nm for nm in os.listdir(dirName) if nm.endswith(_yamlSuffixes)]
+
+
+def _map_files(func, items, workers):
+    "func applied to each of items, by a pool of processes if workers > 1 (or None)"
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(func, items, chunksize=max(1, len(items) // (4 * workers)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parse_all(dirName, workers=1):
+    """
+    Load every yaml file in dirName, returning the set of all their top level keys and
+    the list of records.  With workers > 1 (or None, meaning the number of CPUs) the
+    files are loaded by a pool of that many processes.
+    """
+    fileNames = [os.path.join(dirName, nm) for nm in _yaml_names(dirName)]
+    recs = _map_files(load_one, fileNames, workers)
     allKeys = set()
-    for nm in os.listdir(dirName):
-        if nm.endswith('.yaml'):
-            with open(os.path.join(dirName, nm), 'r') as f:
-                newD = yaml.safe_load(f)
-                allKeys.update(newD.keys())
-                recs.append(newD)
+    for newD in recs:
+        allKeys.update(newD.keys())
     return allKeys, recs
 
 
-def _simplify(entry):
-    if isinstance(entry, types.DictType):
-        pairs = []
-        for k, v in entry.items():
-            if k.find('_prov') >= 0:
-                continue
-            elif k == 'prov':
-                continue
-            elif k == 'value':
-                return v
+def _add_simplified(out, k, simpV):
+    "store the simplified value of key k in the dict out, spreading categorized lists"
+    if isinstance(simpV, types.ListType):
+        newList = []
+        for item in simpV:
+            if (isinstance(item, types.DictType)
+                    and 'category' in item):
+                if 'count' in item:
+                    out[k + item['category']] = item['count']
+                elif 'value' in item:
+                    out[k + item['category']] = item['value']
             else:
-                simpV = _simplify(v)
-                if isinstance(simpV, types.ListType):
-                    newList = []
-                    for item in simpV:
-                        if (isinstance(item, types.DictType)
-                                and 'category' in item):
-                            if 'count' in item:
-                                pairs.append((k + item['category'], item['count']))
-                            elif 'value' in item:
-                                pairs.append((k + item['category'], item['value']))
-                        else:
-                            newList.append(item)
-                    if newList:
-                        pairs.append((k, newList))
-                else:
-                    pairs.append((k, simpV))
-        return dict(pairs)
-    elif isinstance(entry, types.ListType):
-        return [_simplify(e) for e in entry]
+                newList.append(item)
+        if newList:
+            out[k] = newList
     else:
+        out[k] = simpV
+
+
+def _simplify(entry):
+    """
+    Reduce a record to plain values: provenance keys are dropped, a dict with a 'value'
+    key is replaced by that value, and lists of dicts with a 'category' are spread into
+    one key per category.  This walks the record with an explicit stack of
+    [isDict, iterator, output, key] frames rather than by recursion, so nesting depth is
+    not limited by the recursion limit, and leaf values are handled without a frame.
+    """
+    if not isinstance(entry, (types.DictType, types.ListType)):
         return entry
+    stack = []
+    node = entry
+    while True:
+        # node is a dict or list which needs a frame of its own
+        if isinstance(node, types.DictType):
+            stack.append([True, iter(node.items()), {}, None])
+        else:
+            stack.append([False, iter(node), [], None])
+        node = None
+        while stack:
+            frame = stack[-1]
+            isDict, it, out = frame[0], frame[1], frame[2]
+            result = out
+            if isDict:
+                for k, v in it:
+                    if k.find('_prov') >= 0:
+                        continue
+                    elif k == 'prov':
+                        continue
+                    elif k == 'value':
+                        result = v
+                        break
+                    elif isinstance(v, (types.DictType, types.ListType)):
+                        frame[3] = k
+                        node = v
+                        break
+                    else:
+                        out[k] = v
+            else:
+                for v in it:
+                    if isinstance(v, (types.DictType, types.ListType)):
+                        node = v
+                        break
+                    else:
+                        out.append(v)
+            if node is not None:
+                break  # descend into node, then come back to this frame
+            stack.pop()
+            if not stack:
+                return result
+            parent = stack[-1]
+            if parent[0]:
+                _add_simplified(parent[2], parent[3], result)
+            else:
+                parent[2].append(result)
 
 
-def parse_all_simplified(dirName):
-    allKeys, rawRecs = parse_all(dirName)
+def parse_all_simplified(dirName, workers=1):
+    allKeys, rawRecs = parse_all(dirName, workers)
     return allKeys, [_simplify(r) for r in rawRecs]
 
+
+_SIMPLIFIED_CACHE_VERSION = 1
+
+
+def _load_simplified(fileName):
+    "returns the top level keys and the simplified record of one yaml file"
+    rec = load_one(fileName)
+    return list(rec.keys()), _simplify(rec)
+
+
+def _read_simplified_cache(cachePath):
+    try:
+        with open(cachePath, 'rb') as f:
+            version, entries = pickle.load(f)
+        if version == _SIMPLIFIED_CACHE_VERSION:
+            return entries
+    except (IOError, OSError, EOFError, ValueError, TypeError,
+            AttributeError, ImportError, pickle.UnpicklingError):
+        pass
+    return {}
+
+
+def _write_simplified_cache(cachePath, entries):
+    """
+    Write the cache by way of a temporary file and a rename, so a concurrent reader never
+    sees a partial cache.  Failure to write the cache is not an error.
+    """
+    tmpPath = None
+    try:
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(cachePath), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((_SIMPLIFIED_CACHE_VERSION, entries), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, cachePath)
+    except (IOError, OSError, pickle.PicklingError, TypeError):
+        if tmpPath is not None and os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+def parse_all_simplified_cached(dirName, cachePath=None, workers=1):
+    """
+    Returns the same (allKeys, recs) as parse_all_simplified(dirName), but keeps the
+    simplified records in a cache file.  Later calls only load the yaml files which are
+    new or whose modification time or size has changed, and forget deleted ones.
+
+    The cache is the file .simplified.cache in dirName, or cachePath if that is given.
+    New and changed files are loaded by a pool of processes as in parse_all.
+    """
+    if cachePath is None:
+        cachePath = os.path.join(dirName, '.simplified.cache')
+    cached = _read_simplified_cache(cachePath)
+    names = _yaml_names(dirName)
+    entries = {}
+    stale = []
+    for nm in names:
+        st = os.stat(os.path.join(dirName, nm))
+        stamp = (st.st_mtime, st.st_size)
+        if nm in cached and cached[nm][0] == stamp:
+            entries[nm] = cached[nm]
+        else:
+            stale.append((nm, stamp))
+    loaded = _map_files(_load_simplified, [os.path.join(dirName, nm) for nm, stamp in stale],
+                        workers)
+    for (nm, stamp), (keys, rec) in zip(stale, loaded):
+        entries[nm] = (stamp, keys, rec)
+    if stale or len(entries) != len(cached):
+        _write_simplified_cache(cachePath, entries)
+
+    allKeys = set()
+    recs = []
+    for nm in names:
+        stamp, keys, rec = entries[nm]
+        allKeys.update(keys)
+        recs.append(rec)
+    return allKeys, recs
+
 firstKeys = ['name', 'abbrev', 'category']
 
-def save_all(dirName, recList, theseComeFirst=None):
-    newRecs = []
+# The LibYAML emitter when PyYAML was built with it, as for SafeLoader
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def _ordered_rec(rec, theseComeFirst=None):
+    """
+    a copy of rec as an OrderedDict, with the keys in theseComeFirst (if present) first
+    and the rest after them in sorted order, so the text does not depend on dict order
+    """
+    if theseComeFirst is None:
+        theseComeFirst = firstKeys
+    theseComeFirstSet = set(theseComeFirst)
+
+    newRec = OrderedDict()
+    for k in theseComeFirst:
+        if k in rec:
+            newRec[k] = rec[k]
+    for k in sorted(rec):
+        if k not in theseComeFirstSet:
+            newRec[k] = rec[k]
+    return newRec
+
+
+def dump_one(rec, theseComeFirst=None):
+    "the utf-8 encoded yaml text save_one writes for rec"
+    return yaml.dump(_ordered_rec(rec, theseComeFirst), Dumper=SafeDumper,
+                     default_flow_style=False, indent=4,
+                     encoding='utf-8', width=130, explicit_start=True)
+
+
+def _write_if_changed(fileName, text):
+    """
+    Write text to fileName unless the file already holds exactly that text, returning True
+    if the file was written.  The text goes to a temporary file in the same directory
+    which is then renamed over fileName, so readers see either the old file or the new one.
+    An existing file keeps its permissions; a new one gets those open() would give it.
+    """
+    try:
+        with open(fileName, 'rb') as f:
+            if f.read(len(text) + 1) == text:
+                return False
+        oldMode = os.stat(fileName).st_mode & 0o7777
+    except (IOError, OSError):
+        oldMode = None
+    # Created with mode 0666 so the OS applies the umask, as it does for open(); unlike
+    # reading the umask with os.umask(), this leaves it alone for any other threads
+    tmpPath = '%s.%s.tmp' % (fileName, os.urandom(6).encode('hex'))
+    fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(text)
+        if oldMode is not None:
+            os.chmod(tmpPath, oldMode)
+        os.rename(tmpPath, fileName)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    return True
+
+
+def _save_job(job):
+    "a save_all work item: (fileName, rec, theseComeFirst) -> fileName if written"
+    fileName, rec, theseComeFirst = job
+    if _write_if_changed(fileName, dump_one(rec, theseComeFirst)):
+        return fileName
+    return None
+
+
+def save_all(dirName, recList, theseComeFirst=None, workers=1):
+    """
+    Save each record of recList to its own yaml file in dirName, named by its abbrev
+    (or none0.yaml, none1.yaml, ... if it has none), and return the list of files actually
+    written.  Files which already hold exactly the text that would be written are left
+    alone, and the others are replaced atomically.  With workers > 1 (or None, meaning
+    the number of CPUs) the records are serialized and written by a pool of processes.
+    """
+    jobs = []
     noAbbrevCtr = 0
     for rec in recList:
         if 'abbrev' in rec and len(rec['abbrev']) > 0:
@@ -79,25 +314,12 @@ def save_all(dirName, recList, theseComeFirst=None):
             noAbbrevCtr += 1
 
         fullName = os.path.join(dirName, ofname)
-        save_one(fullName, rec, theseComeFirst)
+        jobs.append((fullName, rec, theseComeFirst))
+    return [fileName for fileName in _map_files(_save_job, jobs, workers)
+            if fileName is not None]
+
 
 def save_one(fileName, rec, theseComeFirst=None):
     # Re-copy everything, but with ordered keys
-
-    if theseComeFirst is None:
-        global firstKeys
-        theseComeFirst = firstKeys
-    theseComeFirstSet = set(theseComeFirst)
-
-    newRec = OrderedDict()
-    for k in theseComeFirst:
-        newRec[k] = rec[k]
-    for k in rec:
-        if k not in theseComeFirstSet:
-            newRec[k] = rec[k]
     with open(fileName, 'w') as f:
-        yaml.safe_dump(rec, f,
-                       default_flow_style=False, indent=4,
-                       encoding='utf-8', width=130, explicit_start=True)
-
-    
+        f.write(dump_one(rec, theseComeFirst))
@@ -2,7 +2,7 @@
 # ie $ ogrinfo -al MOZ_adm2.shp > MOZ2.ogrinfo
 #    $ cat MOZ2.ogrinfo
 
-from phacsl.utils.misc.util import ReadFile
+from phacsl.utils.misc.util import openByNameOrFile
 
 from glob import glob
 import os.path
@@ -171,7 +171,7 @@ class OgrShapeFile:
 def readShapeFile(filename, discardInnerRings=True):
     shapes = []
     
-    with ReadFile(filename) as f:
+    with openByNameOrFile(filename, "rb") as f:
         sf = OgrShapeFile(f)
 
         while(True):
@@ -20,11 +20,29 @@ This module holds miscellaneous utility functions that do not have
 a natural home elsewhere.
 """
 
+import io
+import os
 import sys
+import bz2
+import stat
+import zlib
+import mmap
 import types
 import locale
 import codecs
-import gzip
+import chardet
+import collections
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None  # xz input will not be readable
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zstd input will not be readable
 
 
 def isiterable(c):
@@ -143,10 +161,239 @@ def getPreferredOutputEncoding(baseEncoding=None):
     return outEncoding
 
 
+streamBufferBytes = 1 << 20  # read buffer size for the streams openStream returns
+decompressInputBytes = 64 * 1024  # input fed at once to decompressors without max_length
+
+
+class _DecompressingReader(io.RawIOBase):
+    """
+    A raw binary stream of the decompressed contents of another binary stream.
+    newDecompressor() returns an object with a decompress() method and an unused_data
+    attribute, like zlib.decompressobj(); concatenated compressed streams (as from
+    'cat a.gz b.gz') are decompressed one after the other.
+
+    Decompressors which take a max_length and keep the rest of their input in
+    unconsumed_tail (as zlib's do) expand at most streamBufferBytes at a time.  The
+    others are fed decompressInputBytes of input at a time, which bounds their output
+    by the compression ratio of that much input.
+    """
+    def __init__(self, raw, newDecompressor, name):
+        io.RawIOBase.__init__(self)
+        self._raw = raw
+        self._newDecompressor = newDecompressor
+        self._decompressor = newDecompressor()
+        self._bounded = hasattr(self._decompressor, 'unconsumed_tail')
+        self._input = b''
+        self._pending = b''
+        self._offset = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset == len(self._pending):
+            if not self._input:
+                self._input = self._raw.read(streamBufferBytes if self._bounded
+                                             else decompressInputBytes)
+                if not self._input:
+                    # zlib can hold back output even once all its input is consumed
+                    flush = getattr(self._decompressor, 'flush', None)
+                    self._pending = flush() if flush is not None else b''
+                    self._offset = 0
+                    if not self._pending:
+                        return 0
+                    continue
+            self._pending = self._decompress()
+            self._offset = 0
+        n = min(len(b), len(self._pending) - self._offset)
+        b[:n] = self._pending[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def _decompress(self):
+        "decompresses some of self._input, leaving the rest of it there"
+        data = self._input
+        try:
+            if self._bounded:
+                out = self._decompressor.decompress(data, streamBufferBytes)
+                self._input = self._decompressor.unconsumed_tail
+            else:
+                out = self._decompressor.decompress(data)
+                self._input = b''
+        except EOFError:
+            # the previous stream ended exactly at the end of the last read
+            self._decompressor = self._newDecompressor()
+            return b''
+        if self._decompressor.unused_data:
+            self._input = self._decompressor.unused_data + self._input
+            self._decompressor = self._newDecompressor()
+        return out
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        io.RawIOBase.close(self)
+
+
+class _NewlineTranslatingReader(io.RawIOBase):
+    """
+    A raw binary stream of the contents of another one with '\\r\\n' and lone '\\r' line
+    endings translated to '\\n', as reading an ordinary file in 'rU' mode would.
+    """
+    def __init__(self, raw):
+        io.RawIOBase.__init__(self)
+        self._raw = raw
+        self._skipLF = False  # the last chunk ended in '\r', so drop a leading '\n'
+        self.name = raw.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            data = self._raw.read(len(b))
+            if not data:
+                return 0
+            if self._skipLF and data.startswith(b'\n'):
+                data = data[1:]
+                if not data:
+                    self._skipLF = False
+                    continue
+            self._skipLF = data.endswith(b'\r')
+            data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            n = len(data)  # translating never lengthens the data, so this fits in b
+            b[:n] = data
+            return n
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        io.RawIOBase.close(self)
+
+
+def _gzipReader(raw, name):
+    return _DecompressingReader(raw, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), name)
+
+
+def _bz2Reader(raw, name):
+    return _DecompressingReader(raw, bz2.BZ2Decompressor, name)
+
+
+def _xzReader(raw, name):
+    if lzma is None:
+        raise IOError("%s is xz compressed, but the lzma module is not available" % name)
+    return _DecompressingReader(raw, lzma.LZMADecompressor, name)
+
+
+class _ZstdReader(io.RawIOBase):
+    "A raw binary stream of the decompressed contents of a zstd compressed stream"
+    def __init__(self, raw, name):
+        io.RawIOBase.__init__(self)
+        self._raw = raw
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            raw, read_size=streamBufferBytes, read_across_frames=True)
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._reader.readinto(b)
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        io.RawIOBase.close(self)
+
+
+def _zstdReader(raw, name):
+    if zstandard is None:
+        raise IOError("%s is zstd compressed, but the zstandard module is not available"
+                      % name)
+    return _ZstdReader(raw, name)
+
+
+# The leading magic bytes of each compressed format openStream can read
+_streamFormats = [('\x1f\x8b', 'gzip', _gzipReader),
+                  ('BZh', 'bz2', _bz2Reader),
+                  ('\xfd7zXZ\x00', 'xz', _xzReader),
+                  ('\x28\xb5\x2f\xfd', 'zstd', _zstdReader)]
+_magicBytes = max(len(magic) for magic, fmt, reader in _streamFormats)
+
+# File name suffixes of the compressed formats, for code which looks for files by name
+streamSuffixes = ('.gz', '.bz2', '.xz', '.zst')
+
+
+def _sniffStreamFormat(f):
+    """
+    returns the _streamFormats entry matching the open file f, or None for an ordinary
+    file.  Pipes, FIFOs and other files which are not regular files cannot be rewound
+    after their magic bytes are read, so they are left untouched and count as ordinary.
+    """
+    if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        return None
+    magic = f.read(_magicBytes)
+    f.seek(0)
+    for entry in _streamFormats:
+        if magic.startswith(entry[0]):
+            return entry
+    return None
+
+
+def streamFormat(fname):
+    """
+    Returns the name of the compressed format of the named file ('gzip', 'bz2', 'xz' or
+    'zstd') as recognized by its magic bytes, or None for an ordinary file (including
+    anything which is not a regular file, such as a FIFO, which is not even opened).
+    """
+    if not stat.S_ISREG(os.stat(fname).st_mode):
+        return None
+    with open(fname, 'rb') as f:
+        entry = _sniffStreamFormat(f)
+    return None if entry is None else entry[1]
+
+
+def openStream(fname, mode='rU'):
+    """
+    Open the named file for reading, transparently decompressing it if its magic bytes
+    show it to be gzip, bz2, xz or zstd (the last two need the lzma and zstandard modules).
+    The file is opened just once, with a read buffer of streamBufferBytes.  Ordinary files
+    are opened with the given mode.  Decompressed streams are binary, but with 'U' in the
+    mode their '\\r\\n' and '\\r' line endings are translated to '\\n' just as for an ordinary
+    file.  Pipes and FIFOs cannot be sniffed without losing data, so they are always
+    read as they are.
+    """
+    f = open(fname, mode, streamBufferBytes)
+    try:
+        entry = _sniffStreamFormat(f)
+        if entry is None:
+            return f
+        # Read the compressed bytes through a duplicate of the descriptor, since a
+        # universal newline mode would mangle them
+        os.lseek(f.fileno(), 0, os.SEEK_SET)
+        raw = io.open(os.dup(f.fileno()), 'rb', buffering=streamBufferBytes)
+    except:
+        f.close()
+        raise
+    f.close()
+    try:
+        reader = entry[2](raw, fname)
+        if 'U' in mode:
+            reader = _NewlineTranslatingReader(reader)
+        return io.BufferedReader(reader, streamBufferBytes)
+    except:
+        raw.close()
+        raise
+
+
 class openByNameOrFile():
     """
     usable when you have either a filename or a filehandle and don't want to know which.
     Only use this in the context handler case (ie "with openFileOrHandle() as f:")
+
+    Files opened by name for reading go through openStream(), so compressed files are
+    decompressed transparently.
     """
     def __init__(self, ifile, mode='rU'):
         self.handle = None
@@ -154,7 +401,10 @@ class openByNameOrFile():
         if not isinstance(ifile, types.StringTypes):
             self.handle = ifile
         else:
-            self.odfHandle = open(ifile, mode)
+            if mode.startswith('r') and '+' not in mode:
+                self.odfHandle = openStream(ifile, mode)
+            else:
+                self.odfHandle = open(ifile, mode)
             self.handle = self.odfHandle
 
     def __enter__(self):
@@ -165,58 +415,139 @@ class openByNameOrFile():
             self.odfHandle.close()
 
 
-class ReadFile:
+class ReadFile(openByNameOrFile):
+    """
+    Opens a regular or compressed file by name, as a context manager.  This is what
+    openByNameOrFile now does for any file name, and remains for older callers.
     """
-    This is a class that will allow open file context managers for regular
-    or compressed files.
-    
-    This might open and close the file multiple times as it tries to 
-    determine the file type.
+    def __init__(self, fname, mode="rb"):
+        openByNameOrFile.__init__(self, fname, mode)
+
 
-    This should be joined with openByNameOrFile() but for now, I'll let
-    it stand alone so I can get other work done.
+class MappedLines(object):
     """
-    def checkGzip(self):
-        f = None
-        try:
-            f = gzip.open(self.fname, self.mode)
-            f.read(1)
-            f.close()
-            return True
-        except:
-            if f is not None:
-                f.close()
-            return False
-
-    def findType(self):
-        if self.checkGzip():
-            return 'gzip'
-        return 'file'
-
-    def open(self):
-        if self.ftype == 'gzip':
-            self.fh = gzip.open(self.fname, self.mode)
-            return self.fh
-
-        if self.ftype == 'file':
-            self.fh = open(self.fname, self.mode)
-            return self.fh
+    A memory-mapped source of the lines of an uncompressed file, optionally limited to the
+    bytes from start up to end.  It can be used like a file opened in 'rb' mode: iterating
+    over it (or calling readline()) yields each line, line ending included, as a byte
+    string sliced straight out of the mapping rather than through a file buffer.  Since
+    the mapping is backed by the OS page cache, processes reading the same file share a
+    single copy of it.  It is also a context manager which closes the mapping.
+    """
+    def __init__(self, fname, start=0, end=None):
+        self.name = fname
+        with open(fname, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # an empty file cannot be mapped, but then there is nothing to read anyway
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._end = size if end is None else min(end, size)
+        if self._mm is not None:
+            self._mm.seek(min(start, self._end))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def readline(self):
+        mm = self._mm
+        if mm is None or mm.tell() >= self._end:
+            return ''
+        line = mm.readline()
+        over = mm.tell() - self._end
+        if over > 0:
+            line = line[:-over]
+            mm.seek(self._end)
+        return line
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
 
     def close(self):
-        if self.ftype == 'gzip':
-            self.fh.close()
-        elif self.ftype == 'file':
-            self.fh.close()
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
 
-    def __init__(self, fname, mode = "rb"):
-        self.fname = fname
-        self.mode = mode
 
-        self.ftype = self.findType()
+encodingSampleBytes = 64 * 1024  # how much of a file guessEncoding gets to look at
+# sniffEncoding's results, by absolute path, with the (mtime, size) they were found at.
+# Only the encodingCacheEntries most recently used are kept.
+encodingCacheEntries = 4096
+_encodingCache = collections.OrderedDict()
 
-    def __enter__(self):
-        return self.open()
+_BOMs = [(codecs.BOM_UTF8, 'utf-8-sig'),
+         (codecs.BOM_UTF32_LE, 'utf-32'),  # must precede UTF16_LE, which is its prefix
+         (codecs.BOM_UTF32_BE, 'utf-32'),
+         (codecs.BOM_UTF16_LE, 'utf-16'),
+         (codecs.BOM_UTF16_BE, 'utf-16')]
 
-    def __exit__(self, type, value, traceback):
-        self.close()
 
+def guessEncoding(sample):
+    """
+    Guess the encoding of a byte string, returning an (encoding, confidence) tuple in the
+    style of chardet.detect.  A byte order mark or a sample which is valid UTF-8 (which
+    includes plain ASCII) is recognized directly; only otherwise is chardet consulted.
+    """
+    for bom, encoding in _BOMs:
+        if sample.startswith(bom):
+            return encoding, 1.0
+    try:
+        # final=False tolerates a multi-byte character cut off at the end of the sample
+        codecs.getincrementaldecoder('utf-8')().decode(sample, False)
+        return 'utf-8', 1.0
+    except UnicodeDecodeError:
+        pass
+    encodingInfo = chardet.detect(sample)
+    return encodingInfo['encoding'], encodingInfo['confidence']
+
+
+def sampleLines(lines, nBytes=encodingSampleBytes):
+    """
+    The first of the given lines (an open file or other iterator), stopping as soon as they
+    add up to nBytes or more.  A reader can guess the encoding from them with
+    sniffEncoding and then go on with itertools.chain(sample, lines), so the file is
+    read just once.
+    """
+    sample = []
+    total = 0
+    for line in lines:
+        sample.append(line)
+        total += len(line)
+        if total >= nBytes:
+            break
+    return sample
+
+
+def sniffEncoding(fname, sample=None):
+    """
+    Returns guessEncoding() of sample, the leading bytes of the named file as already read
+    by the caller, or if that is None of the first encodingSampleBytes of the file.
+    Results for regular files are cached by path, modification time and size, so
+    repeated loads of an unchanged file skip the detection entirely; the
+    encodingCacheEntries most recently used are kept.  Since only a regular file can be
+    read twice, the sample must be given for anything else, such as a FIFO.
+    """
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    cacheable = stat.S_ISREG(st.st_mode)
+    stamp = (st.st_mtime, st.st_size)
+    if cacheable and path in _encodingCache and _encodingCache[path][0] == stamp:
+        # move it to the most recently used end
+        _encodingCache[path] = _encodingCache.pop(path)
+        return _encodingCache[path][1]
+    if sample is None:
+        with openStream(path, 'rb') as f:
+            sample = f.read(encodingSampleBytes)
+    result = guessEncoding(sample)
+    if cacheable:
+        _encodingCache.pop(path, None)
+        _encodingCache[path] = (stamp, result)
+        while len(_encodingCache) > encodingCacheEntries:
+            _encodingCache.popitem(last=False)
+    return result
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+"""
+Throughput benchmarks for csv_tools.  These are not unit tests; run this file directly.
+"""
+
+import sys
+import time
+
+import phacsl.utils.formats.csv_tools as csv_tools
+
+
+def sampleLines(nLines):
+    line = (u'"Dometic/Electrolux","RCW 42 EK/CF",1169,"EUR",0.7,"liters/day",'
+            u'"PQS 2000 - raw liters"\n')
+    return [line] * nLines
+
+
+def timeSplit(splitter, lines):
+    t0 = time.time()
+    for line in lines:
+        splitter.findall(line)
+    return time.time() - t0
+
+
+def benchSplit(nLines=200000):
+    lines = sampleLines(nLines)
+    nBytes = sum([len(l) for l in lines])
+    results = [('regex', timeSplit(csv_tools.makeSplitRegex(','), lines))]
+    if csv_tools.Splitter is not None:
+        results.append(('csvsplit', timeSplit(csv_tools.makeSplitter(','), lines)))
+    else:
+        print("csvsplit extension is not built; timing the regex only")
+    for label, secs in results:
+        print(("%-10s %8.3f sec  %8.1f Klines/sec  %6.1f MB/sec"
+               % (label, secs, 0.001 * nLines / secs, 1.0e-6 * nBytes / secs)))
+
+
+def main():
+    nLines = 200000
+    if len(sys.argv) > 1:
+        nLines = int(sys.argv[1])
+    benchSplit(nLines)
+
+
+############
+# Main hook
+############
+
+if __name__ == "__main__":
+    main()
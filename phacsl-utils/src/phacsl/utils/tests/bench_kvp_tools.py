@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+"""
+Throughput benchmarks for kvp_tools.  These are not unit tests; run this file directly.
+"""
+
+import sys
+import time
+
+import phacsl.utils.formats.kvp_tools as kvp_tools
+
+
+def sampleLines(nLines):
+    templates = ['# parameter sweep %d\n',
+                 'runDays%d = 365\n',
+                 'scale%d = -4.2E-03   # a float\n',
+                 'name%d = "Depot Central"\n',
+                 'levels%d = 12,34;56:\'foo\',7.5\n',
+                 'enabled%d = true\n',
+                 'flag%d\n']
+    return [templates[i % len(templates)] % i for i in xrange(nLines)]
+
+
+def timeParse(parser, lines):
+    t0 = time.time()
+    result = parser.parse(lines, encoding='utf8')
+    return time.time() - t0, result
+
+
+def benchParse(nLines=100000):
+    lines = sampleLines(nLines)
+    nBytes = sum([len(l) for l in lines])
+    results = []
+    for label, fastPath in [('fsm', False), ('fast', True)]:
+        parser = kvp_tools.KVPParser()
+        parser.fastPath = fastPath
+        secs, result = timeParse(parser, lines)
+        results.append(result)
+        print(("%-10s %8.3f sec  %8.1f Klines/sec  %6.1f MB/sec"
+               % (label, secs, 0.001 * nLines / secs, 1.0e-6 * nBytes / secs)))
+    assert results[0] == results[1], "the parse paths disagree"
+
+
+def main():
+    nLines = 100000
+    if len(sys.argv) > 1:
+        nLines = int(sys.argv[1])
+    benchParse(nLines)
+
+
+############
+# Main hook
+############
+
+if __name__ == "__main__":
+    main()
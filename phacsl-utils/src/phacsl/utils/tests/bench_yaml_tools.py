@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+"""
+Benchmarks for yaml_tools record simplification.  These are not unit tests; run this file
+directly.
+"""
+
+import sys
+import time
+import types
+
+import phacsl.utils.formats.yaml_tools as yaml_tools
+
+
+def recursiveSimplify(entry):
+    "the recursive form of yaml_tools._simplify, kept as the reference for comparison"
+    if isinstance(entry, types.DictType):
+        pairs = []
+        for k, v in entry.items():
+            if k.find('_prov') >= 0 or k == 'prov':
+                continue
+            if k == 'value':
+                return v
+            simpV = recursiveSimplify(v)
+            if isinstance(simpV, types.ListType):
+                newList = []
+                for item in simpV:
+                    if isinstance(item, types.DictType) and 'category' in item:
+                        if 'count' in item:
+                            pairs.append((k + item['category'], item['count']))
+                        elif 'value' in item:
+                            pairs.append((k + item['category'], item['value']))
+                    else:
+                        newList.append(item)
+                if newList:
+                    pairs.append((k, newList))
+            else:
+                pairs.append((k, simpV))
+        return dict(pairs)
+    elif isinstance(entry, types.ListType):
+        return [recursiveSimplify(e) for e in entry]
+    else:
+        return entry
+
+
+def sampleRecord(i):
+    return {'name': 'Depot %d' % i,
+            'name_prov': 'survey 2014',
+            'abbrev': 'D%d' % i,
+            'population': {'value': 1000 + i, 'prov': 'census'},
+            'staff': [{'category': 'Nurse', 'count': 3},
+                      {'category': 'Clerk', 'count': 1},
+                      {'category': 'Driver', 'value': 2}],
+            'storage': [{'category': 'Fridge', 'count': 2}, 'ColdBox'],
+            'location': {'lat': 1.5, 'lon': 2.5, 'lat_prov': 'gps'},
+            'routes': [{'to': 'D%d' % (i + 1), 'days': [1, 3, 5]}, {'to': 'D0', 'days': [2]}]}
+
+
+def deepRecord(depth):
+    rec = {'leaf': 1}
+    for i in xrange(depth):
+        rec = {'level': i, 'child': [rec]}
+    return rec
+
+
+def benchSimplify(nRecs=20000):
+    recs = [sampleRecord(i) for i in xrange(nRecs)]
+    results = []
+    for label, func in [('recursive', recursiveSimplify), ('iterative', yaml_tools._simplify)]:
+        t0 = time.time()
+        results.append([func(rec) for rec in recs])
+        secs = time.time() - t0
+        print(("%-10s %8.3f sec  %8.1f Krecs/sec" % (label, secs, 0.001 * nRecs / secs)))
+    assert results[0] == results[1], "the simplifiers disagree"
+
+    depth = 10 * sys.getrecursionlimit()
+    t0 = time.time()
+    yaml_tools._simplify(deepRecord(depth))
+    print(("%-10s %8.3f sec  nesting depth %d" % ('deep', time.time() - t0, depth)))
+
+
+def main():
+    nRecs = 20000
+    if len(sys.argv) > 1:
+        nRecs = int(sys.argv[1])
+    benchSimplify(nRecs)
+
+
+############
+# Main hook
+############
+
+if __name__ == "__main__":
+    main()
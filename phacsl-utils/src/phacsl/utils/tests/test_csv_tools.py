@@ -16,8 +16,18 @@
 ###################################################################################
 
 import sys
+import os.path
+import shutil
+import unittest
+import tempfile
+import StringIO
+import cPickle as pickle
+import numpy as np
 
 import phacsl.utils.formats.csv_tools as csv_tools
+from phacsl.utils.misc import util
+
+TEST_CSV = os.path.join(os.path.dirname(__file__), '..', 'test_csv_input.csv')
 
 
 def main():
@@ -55,6 +65,283 @@ def main():
     else:
         print("No input files to check")
 
+
+class TestCSVTools(unittest.TestCase):
+
+    def test_itercsv(self):
+        keys, recs = csv_tools.parseCSV(TEST_CSV)
+        rows = csv_tools.iterCSV(TEST_CSV)
+        self.assertEqual(next(rows), keys)
+        self.assertEqual(list(rows), recs)
+
+    def test_mappedlines(self):
+        with util.MappedLines(TEST_CSV) as lines:
+            self.assertEqual(csv_tools.parseCSV(lines), csv_tools.parseCSV(TEST_CSV))
+
+    def test_itercsv_streams(self):
+        class CountingFile(StringIO.StringIO):
+            name = 'counting file'
+            linesRead = 0
+
+            def next(self):
+                CountingFile.linesRead += 1
+                return StringIO.StringIO.next(self)
+
+        nLines = 5 * csv_tools.sniffLines
+        text = 'a,b,c\n' + ''.join(['%d,%d.5,s%d\n' % (i, i, i) for i in xrange(nLines)])
+        rows = csv_tools.iterCSV(CountingFile(text))
+        self.assertEqual(next(rows), ['a', 'b', 'c'])
+        self.assertEqual(next(rows), {'a': 0, 'b': 0.5, 'c': 's0'})
+        self.assertTrue(CountingFile.linesRead < nLines)
+        self.assertEqual(len(list(rows)), nLines - 1)
+
+    splitSamples = [u'', u'a', u'a,b,c', u'a,b,c\n', u'a,,c,', u' a , b ,c ',
+                    u'"a","b","c"\n', u'"a, with comma","b"', u"'single','quoted'",
+                    u'"unterminated,b', u'"x"y,z', u'"x" ,"y" \n', u"it's,Bob's,",
+                    u'"esc\\"aped",b', u'"",\'\',""\n', u'\t"a"\t,\tb\t\r\n',
+                    u'"mixed\' quotes",\'and "more"\'', u'x,"",NA,1.5%,-3\n',
+                    u'"Dometic/Electrolux","RCW8",245,"PQS 2013 \u2013 ice packs"']
+
+    @unittest.skipIf(csv_tools.Splitter is None, "csvsplit extension is not built")
+    def test_splitter_matches_regex(self):
+        for delim in [',', ';']:
+            splitRegex = csv_tools.makeSplitRegex(delim)
+            splitter = csv_tools.makeSplitter(delim)
+            self.assertTrue(isinstance(splitter, csv_tools.Splitter))
+            for line in TestCSVTools.splitSamples:
+                line = line.replace(u',', delim)
+                self.assertEqual(splitter.findall(line), splitRegex.findall(line))
+            with open(TEST_CSV, 'rU') as f:
+                for line in f:
+                    line = line.decode('utf-8')
+                    self.assertEqual(splitter.findall(line), splitRegex.findall(line))
+
+    def test_parsecsvparallel(self):
+        self.assertEqual(csv_tools.parseCSVParallel(TEST_CSV, workers=3, minChunkBytes=500),
+                         csv_tools.parseCSV(TEST_CSV))
+        fd, fname = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write('name;frac;count\r\n')
+                for i in xrange(2000):
+                    f.write('"row %d";%d%%;%d\r\n' % (i, i, i))
+            keys, recs = csv_tools.parseCSVParallel(fname, workers=4, minChunkBytes=1000)
+            self.assertEqual((keys, recs), csv_tools.parseCSV(fname))
+            self.assertEqual(len(recs), 2000)
+            self.assertEqual(recs[1999], {'name': '"row 1999"', 'frac': 0.01 * 1999, 'count': 1999})
+
+            # lone '\r' line endings, alone or mixed with others, read as parseCSV reads them
+            with open(fname, 'rb') as f:
+                data = f.read()
+            for text in [data.replace('\r\n', '\r'), data.replace('3\r\n', '3\r')]:
+                with open(fname, 'wb') as f:
+                    f.write(text)
+                keys, recs = csv_tools.parseCSVParallel(fname, workers=4, minChunkBytes=1000)
+                self.assertEqual((keys, recs), csv_tools.parseCSV(fname))
+                self.assertEqual(len(recs), 2000)
+        finally:
+            os.remove(fname)
+
+    def test_parsecsv_pipe(self):
+        # the encoding is guessed from the lines already read, so a pipe is read just once
+        r, w = os.pipe()
+        try:
+            os.write(w, 'a,b\n1,2\n')
+            os.close(w)
+            w = None
+            opened = []
+            openStream = util.openStream
+
+            def countingOpenStream(fname, mode='rU'):
+                opened.append(fname)
+                return openStream(fname, mode)
+            util.openStream = countingOpenStream
+            try:
+                self.assertEqual(csv_tools.parseCSV('/dev/fd/%d' % r),
+                                 ([u'a', u'b'], [{u'a': 1, u'b': 2}]))
+            finally:
+                util.openStream = openStream
+            self.assertEqual(len(opened), 1)
+        finally:
+            os.close(r)
+            if w is not None:
+                os.close(w)
+
+    def test_parsecsvcached(self):
+        cacheDir = tempfile.mkdtemp()
+        fname = os.path.join(cacheDir, 'sample.csv')
+        try:
+            with open(TEST_CSV, 'rb') as ifile, open(fname, 'wb') as ofile:
+                ofile.write(ifile.read())
+            expected = csv_tools.parseCSV(fname)
+            self.assertEqual(csv_tools.parseCSVCached(fname), expected)
+            cachePath = os.path.join(cacheDir, '.sample.csv.csvcache')
+            self.assertTrue(os.path.exists(cachePath))
+            keys, recs = csv_tools.parseCSVCached(fname)
+            self.assertEqual((keys, recs), expected)
+            self.assertTrue(isinstance(recs[0], csv_tools.CSVDict))
+
+            with open(fname, 'ab') as ofile:
+                ofile.write('"a","b","c","d","e","f","g",1,"h",2,3.5,"i",4,5,6,7,'
+                            '"j","k","l",8,9,10,"m"\n')
+            keys, recs = csv_tools.parseCSVCached(fname)
+            self.assertEqual(len(recs), len(expected[1]) + 1)
+            self.assertEqual(recs[-1]['PowerRate'], 3.5)
+        finally:
+            shutil.rmtree(cacheDir)
+
+    def test_csvwriter(self):
+        keys, recs = csv_tools.parseCSV(TEST_CSV)
+        outDir = tempfile.mkdtemp()
+        try:
+            expectedName = os.path.join(outDir, 'expected.csv')
+            csv_tools.writeCSV(expectedName, keys, list(recs), quoteStrings=True,
+                               sortColumn='Model')
+            writerName = os.path.join(outDir, 'writer.csv')
+            with csv_tools.CSVWriter(writerName, keys, quoteStrings=True, bufferRows=7) as w:
+                w.writerows((rec for rec in recs), sortKey=lambda r: r['Model'].lower(),
+                            maxInMemory=10)
+            with open(expectedName, 'rb') as f1, open(writerName, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(w.nRecs, len(recs))
+            keys2, recs2 = csv_tools.parseCSV(writerName)
+            self.assertEqual(keys2, keys)
+            self.assertEqual(recs2, sorted(recs, key=lambda r: r['Model'].lower()))
+
+            # a lone record without the sort column is written as it is
+            csv_tools.writeCSV(writerName, ['a', 'b'], [{'b': 1}], sortColumn='a')
+            with open(writerName, 'rb') as f:
+                self.assertEqual(f.read(), 'a,b\nNA,1\n')
+        finally:
+            shutil.rmtree(outDir)
+
+    def test_parsecsvcolumnar(self):
+        sio = StringIO.StringIO('a,b,c,d\n1,2%,-3,x\n4,50%,+5,NA\n7,,8.5,y\n')
+        sio.name = 'columnar sample'
+        cols = csv_tools.parseCSVColumnar(sio)
+        self.assertEqual(cols.keys(), ['a', 'b', 'c', 'd'])
+        self.assertEqual(cols['a'].dtype, np.int64)
+        self.assertEqual(cols['a'].tolist(), [1, 4, 7])
+        self.assertEqual(cols['b'].dtype, np.float64)
+        self.assertEqual(cols['b'].tolist(), [0.02, 0.5, None])
+        self.assertEqual(cols['c'].tolist(), [-3.0, 5.0, 8.5])
+        self.assertEqual(cols['d'].tolist(), ['x', None, 'y'])
+
+        keys, recs = csv_tools.parseCSV(TEST_CSV)
+        cols = csv_tools.parseCSVColumnar(TEST_CSV)
+        self.assertEqual(cols.keys(), keys)
+        for key in ['BaseCost', 'Name', 'NoPowerHoldoverDays']:
+            for rec, val in zip(recs, cols[key].tolist()):
+                self.assertEqual(rec[key], '' if val is None else val)
+
+    def test_castcolumnbatch(self):
+        ct = csv_tools.castTypes
+        cells = [u'12', 3.7, u'', None, u'abc', 4, u'1e3', u'-2', 'T']
+        for castList in [[ct.INT], [ct.EMPTY_IS_ZERO, ct.FLOAT], [ct.POSITIVE_INT, ct.STRING],
+                         [ct.EMPTY_IS_NONE, ct.BOOLEAN], [ct.NA, ct.NONNEGATIVE_INT, ct.STRING]]:
+            recs = [csv_tools.CSVDict(k=v) for v in cells]
+            expected = []
+            for v in cells:
+                for cast in castList:
+                    ok, result = cast(v)
+                    if ok:
+                        break
+                expected.append(result if ok else v)
+            failed = csv_tools.castColumnBatch(recs, 'k', castList)
+            self.assertEqual([rec['k'] for rec in recs], expected)
+            self.assertEqual([e.line for e in failed],
+                             [i + 1 for i, v in enumerate(cells)
+                              if not any(cast(v)[0] for cast in castList)])
+
+        recs = [csv_tools.CSVDict(k=v) for v in [u'1', u'2', u'x']]
+        failed = csv_tools.castColumnBatch(recs, 'k', ct.INT, fileName='t.csv')
+        try:
+            csv_tools.castColumn(recs, 'k', ct.INT, fileName='t.csv')
+        except csv_tools.castFail as e:
+            self.assertEqual([str(f) for f in failed], [str(e)])
+        self.assertEqual((failed[0].failedVal, failed[0].line), (u'x', 3))
+        self.assertEqual(csv_tools.castColumnBatch([], 'k', ct.INT), [])
+
+        # whole columns of number words take numpy's text parser
+        words = [u'12', u'-7', u'+3', u'0012', u'-', u'1.5', u'99999999999999999999', u'1,2']
+        recs = [csv_tools.CSVDict(k=v) for v in words]
+        failed = csv_tools.castColumnBatch(recs, 'k', [ct.INT, ct.FLOAT, ct.STRING])
+        self.assertEqual(failed, [])
+        self.assertEqual([rec['k'] for rec in recs],
+                         [12, -7, 3, 12, u'-', 1.5, 99999999999999999999L, u'1,2'])
+        self.assertEqual(type(recs[6]['k']), long)
+
+    def test_schema(self):
+        ct = csv_tools.castTypes
+        columns = [('Name', [ct.STRING]),
+                   ('BaseCost', [ct.EMPTY_IS_NONE, ct.FLOAT]),
+                   ('NoPowerHoldoverDays', [ct.EMPTY_IS_ZERO, ct.FLOAT], True, None, 'holdover'),
+                   csv_tools.CSVColumn('Missing', ct.INT, required=False, default=-1)]
+        schema = csv_tools.CSVSchema('TestSchemaRow', columns)
+        self.assertEqual(schema.fields, ['Name', 'BaseCost', 'holdover', 'Missing'])
+
+        keys, recs = csv_tools.parseCSV(TEST_CSV)
+        for col in schema.columns[:3]:
+            csv_tools.castColumn(recs, col.name, col.castList)
+        expected = [(rec['Name'], rec['BaseCost'], rec['NoPowerHoldoverDays'], -1) for rec in recs]
+        fields, rows = csv_tools.parseCSV(TEST_CSV, schema)
+        self.assertEqual(fields, schema.fields)
+        self.assertTrue(all(isinstance(row, schema.rowType) for row in rows))
+        self.assertEqual([tuple(row) for row in rows], expected)
+        self.assertEqual(rows[0].holdover, 0)
+        self.assertEqual(csv_tools.parseCSV((keys, recs), schema)[1], rows)
+
+        sio = StringIO.StringIO('a,b\n1,x\n2.5,y\n3%,z\n')
+        sio.name = 'schema sample'
+        intSchema = csv_tools.CSVSchema('TestSchemaInts', [('a', [ct.INT, ct.STRING])])
+        self.assertEqual([row.a for row in csv_tools.parseCSV(sio, intSchema)[1]], [1, 2, 0])
+        badSchema = csv_tools.CSVSchema('TestSchemaBad', [('b', ct.INT)])
+        sio.seek(0)
+        self.assertRaises(csv_tools.castFail, csv_tools.parseCSV, sio, badSchema)
+        sio.seek(0)
+        self.assertRaises(RuntimeError, csv_tools.parseCSV, sio, schema)
+
+    def test_csvrow(self):
+        keys, recs = csv_tools.parseCSV(TEST_CSV)
+        cKeys, rows = csv_tools.parseCSV(TEST_CSV, compact=True)
+        self.assertEqual(cKeys, keys)
+        self.assertTrue(all(isinstance(row, csv_tools.CSVRow) for row in rows))
+        self.assertTrue(rows[0]._header is rows[-1]._header)
+        self.assertEqual(rows, recs)
+        self.assertEqual(rows[2].keys(), keys)
+        self.assertEqual(rows[2].getFloat(['Missing', 'BaseCost']), recs[2].getFloat('BaseCost'))
+        self.assertEqual(rows[0].safeGetFloat('Notes', 7.0), 7.0)
+        self.assertEqual(rows[0].safeGetFloat('BaseCost', 7.0, ignore=0), 7.0)
+
+        row = rows[2].copy()
+        row['extra'] = 5
+        del row['Make']
+        self.assertFalse('Make' in row)
+        self.assertRaises(KeyError, row.__getitem__, 'Make')
+        self.assertEqual(row.pop('extra'), 5)
+        self.assertEqual(len(row), len(keys) - 1)
+        self.assertNotEqual(row, rows[2])
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+
+        csv_tools.castColumn(rows, 'BaseCost', [csv_tools.castTypes.EMPTY_IS_NONE,
+                                                csv_tools.castTypes.FLOAT])
+        self.assertTrue(isinstance(rows[1]['BaseCost'], float))
+
+    def test_usecols(self):
+        keys, recs = csv_tools.parseCSV(TEST_CSV)
+        self.assertEqual(csv_tools.parseCSVHeader(TEST_CSV), keys)
+        with open(TEST_CSV, 'rU') as f:
+            self.assertEqual(csv_tools.parseCSVHeader(f), keys)
+
+        usecols = ['Name', 'Make', 'BaseCost']
+        pKeys, pRecs = csv_tools.parseCSV(TEST_CSV, usecols=usecols)
+        self.assertEqual(pKeys, ['Make', 'BaseCost', 'Name'])
+        self.assertEqual(pRecs, [dict((k, rec[k]) for k in pKeys) for rec in recs])
+        self.assertEqual(csv_tools.parseCSV(TEST_CSV, compact=True, usecols=usecols)[1], pRecs)
+        self.assertEqual(csv_tools.parseCSV((keys, recs), usecols=usecols), (pKeys, pRecs))
+        self.assertRaises(RuntimeError, csv_tools.parseCSV, TEST_CSV, usecols=['Make', 'Nope'])
+
+
 ############
 # Main hook
 ############
@@ -16,8 +16,11 @@
 #                                                                                 #
 ###################################################################################
 
+import os
 import sys
+import shutil
 import unittest
+import tempfile
 import types
 import StringIO
 
@@ -111,6 +114,137 @@ class TestKVPTools(unittest.TestCase):
             # print "<%s>:<%s>"%(k,v)
             self.assertTrue(k in totalDict and totalDict[k] == v)
 
+    def test_fastpath(self):
+        fsmParser = kvp_tools.KVPParser()
+        fsmParser.fastPath = False
+        fastParser = kvp_tools.KVPParser()
+        lines = [rec + '\n' for rec, expectedResult in TestKVPTools.samples
+                 if isinstance(expectedResult, types.DictType)]
+        lines += ["emptystring = ''", 'noval =', '   \n']
+        self.assertEqual(fastParser.parse(lines, encoding='utf8'),
+                         fsmParser.parse(lines, encoding='utf8'))
+        for bad in ['someidentifier,', 'x = $', 'x = 1 2']:
+            for parser in [fsmParser, fastParser]:
+                self.assertRaises(ParserException, parser.parse, [bad], encoding='utf8')
+
+    def test_parse_pipe(self):
+        r, w = os.pipe()
+        try:
+            os.write(w, 'day = 10\nname = "caf\xc3\xa9"\n')
+            os.close(w)
+            w = None
+            self.assertEqual(kvp_tools.KVPParser().parse('/dev/fd/%d' % r),
+                             {'day': 10, 'name': u'caf\xe9'})
+        finally:
+            os.close(r)
+            if w is not None:
+                os.close(w)
+
+    def test_parsemany(self):
+        parser = kvp_tools.KVPParser()
+        tmpDir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in xrange(6):
+                paths.append(os.path.join(tmpDir, 'sweep%d.kvp' % i))
+                with open(paths[-1], 'w') as f:
+                    f.write('run = %d\nlevels = 1,2,%d\nname = "sweep"\n' % (i, i))
+            expected = dict((path, parser.parse(path)) for path in paths)
+            self.assertEqual(parser.parseMany(paths, workers=3), expected)
+            kvp_tools._parseCache.clear()
+            self.assertEqual(parser.parseMany(paths, workers=2, processes=False), expected)
+
+            # the workers parse with the caller's settings
+            settings = []
+            original = kvp_tools.KVPParser.parse
+
+            def parse(self, path, encoding=None):
+                settings.append((self.verbose, self.debug, self.fastPath))
+                return original(self, path, encoding)
+            kvp_tools.KVPParser.parse = parse
+            try:
+                kvp_tools._parseCache.clear()
+                slow = kvp_tools.KVPParser()
+                slow.fastPath = False
+                self.assertEqual(slow.parseMany(paths, workers=2, processes=False), expected)
+            finally:
+                kvp_tools.KVPParser.parse = original
+            self.assertEqual(set(settings), set([(0, 0, False)]))
+
+            # unchanged files come from the cache, and callers get their own copies
+            cacheKey = (os.path.abspath(paths[0]), None)
+            kvp_tools._parseCache[cacheKey][1]['marker'] = True
+            results = parser.parseMany(paths)
+            self.assertTrue(results[paths[0]]['marker'])
+            results[paths[0]]['levels'].append(99)
+            self.assertEqual(parser.parseMany(paths)[paths[0]]['levels'], [1, 2, 0])
+
+            with open(paths[0], 'a') as f:
+                f.write('extra = 1\n')
+            self.assertEqual(parser.parseMany(paths)[paths[0]], parser.parse(paths[0]))
+
+            # only the most recently used results are kept
+            entries = kvp_tools.parseCacheEntries
+            kvp_tools.parseCacheEntries = 4
+            try:
+                kvp_tools._parseCache.clear()
+                parser.parseMany(paths[:3])
+                parser.parseMany(paths[3:], workers=1)
+                self.assertEqual([key[0] for key in kvp_tools._parseCache],
+                                 [os.path.abspath(path) for path in paths[2:]])
+            finally:
+                kvp_tools.parseCacheEntries = entries
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_updatekvp(self):
+        parser = kvp_tools.KVPParser()
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpDir, 'state.kvp')
+            original = ('# checkpoint state\r\n'
+                        'day = 10   # current day\r\n'
+                        'name = "a#b"\r\n'
+                        '\r\n'
+                        'levels = 1,2\r\n'
+                        'done = false\r\n')
+            with open(fname, 'wb') as f:
+                f.write(original)
+            self.assertFalse(parser.updateKVP(fname, {'day': 10, 'levels': [1, 2]}))
+            self.assertTrue(parser.updateKVP(fname, {'day': 11, 'levels': [1, 2],
+                                                     'extra': [u'D\xe9p', 3.5]}))
+            with open(fname, 'rb') as f:
+                lines = f.read().splitlines(True)
+            self.assertEqual(lines[1], 'day = 11   # current day\r\n')
+            self.assertEqual(lines[:1] + lines[2:6], original.splitlines(True)[:1]
+                             + original.splitlines(True)[2:])
+            self.assertEqual(lines[6], 'extra = "D\xc3\xa9p",3.5\n')
+            self.assertEqual(parser.parse(fname), {'day': 11, 'name': 'a#b', 'levels': [1, 2],
+                                                   'done': False, 'extra': [u'D\xe9p', 3.5]})
+
+            d = parser.parse(fname)
+            parser.writeKVP(fname, d)
+            self.assertEqual(parser.parse(fname), d)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_updatekvp_bom(self):
+        parser = kvp_tools.KVPParser()
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpDir, 'state.kvp')
+            with open(fname, 'wb') as f:
+                f.write('\xef\xbb\xbfa = 1\t# \xc3\xa9t\xc3\xa9\nb = 2\n')
+            self.assertTrue(parser.updateKVP(fname, {'a': 5, 'b': u'D\xe9p', 'c': 4},
+                                             encoding='utf-8-sig'))
+            with open(fname, 'rb') as f:
+                self.assertEqual(f.read(), '\xef\xbb\xbfa = 5\t# \xc3\xa9t\xc3\xa9\n'
+                                           'b = "D\xc3\xa9p"\nc = 4\n')
+            self.assertEqual(parser.parse(fname, encoding='utf-8-sig'),
+                             {'a': 5, 'b': u'D\xe9p', 'c': 4})
+        finally:
+            shutil.rmtree(tmpDir)
+
 ############
 # Main hook
 ############
@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+import os
+import bz2
+import gzip
+import codecs
+import shutil
+import unittest
+import tempfile
+import StringIO
+
+from phacsl.utils.misc import util
+
+
+class TestUtil(unittest.TestCase):
+
+    def test_guessencoding(self):
+        self.assertEqual(util.guessEncoding('plain ascii'), ('utf-8', 1.0))
+        self.assertEqual(util.guessEncoding(u'D\xe9p\xf4t'.encode('utf-8')), ('utf-8', 1.0))
+        # a multi-byte character cut off by the sample boundary is still utf-8
+        self.assertEqual(util.guessEncoding(u'D\xe9p\xf4t'.encode('utf-8')[:2]), ('utf-8', 1.0))
+        self.assertEqual(util.guessEncoding(codecs.BOM_UTF8 + 'abc'), ('utf-8-sig', 1.0))
+        self.assertEqual(util.guessEncoding(u'abc'.encode('utf-16')), ('utf-16', 1.0))
+        self.assertEqual(util.guessEncoding(u'abc'.encode('utf-32')), ('utf-32', 1.0))
+        self.assertNotEqual(util.guessEncoding(u'D\xe9p\xf4t Central'.encode('latin-1'))[0],
+                            'utf-8')
+
+    def test_sniffencoding_cache(self):
+        fd, fname = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(u'caf\xe9 = 1\n'.encode('utf-8'))
+            self.assertEqual(util.sniffEncoding(fname), ('utf-8', 1.0))
+            path = os.path.abspath(fname)
+            stamp, result = util._encodingCache[path]
+            util._encodingCache[path] = (stamp, ('marker', 0.5))
+            self.assertEqual(util.sniffEncoding(fname), ('marker', 0.5))
+            with open(fname, 'ab') as f:
+                f.write(codecs.BOM_UTF8)  # size changes, so the cache entry is stale
+            self.assertEqual(util.sniffEncoding(fname), ('utf-8', 1.0))
+
+            # a sample read by the caller is used instead of reading the file again
+            self.assertEqual(util.sniffEncoding(fname, codecs.BOM_UTF16_LE), ('utf-8', 1.0))
+            del util._encodingCache[path]
+            self.assertEqual(util.sniffEncoding(fname, codecs.BOM_UTF16_LE), ('utf-16', 1.0))
+
+            # only the most recently used results are kept
+            entries = util.encodingCacheEntries
+            util.encodingCacheEntries = 1
+            try:
+                util.sniffEncoding(__file__)
+                self.assertEqual(util._encodingCache.keys(), [os.path.abspath(__file__)])
+            finally:
+                util.encodingCacheEntries = entries
+        finally:
+            os.remove(fname)
+
+    def test_openstream(self):
+        data = ''.join('line %d,\xe9\r\n' % i for i in xrange(5000))
+        compressors = [('gzip', lambda d: _gzipped(d) + _gzipped(d[:7]), data + data[:7]),
+                       ('bz2', bz2.compress, data)]
+        if util.lzma is not None:
+            compressors.append(('xz', util.lzma.compress, data))
+        if util.zstandard is not None:
+            compressors.append(('zstd', util.zstandard.ZstdCompressor().compress, data))
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpDir, 'plain.txt')
+            with open(fname, 'wb') as f:
+                f.write(data)
+            self.assertEqual(util.streamFormat(fname), None)
+            with util.openByNameOrFile(fname, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            for fmt, compress, expected in compressors:
+                fname = os.path.join(tmpDir, 'data.' + fmt)
+                with open(fname, 'wb') as f:
+                    f.write(compress(data))
+                self.assertEqual(util.streamFormat(fname), fmt)
+                with util.openByNameOrFile(fname) as f:
+                    self.assertEqual(f.name, fname)
+                    self.assertEqual(list(f), expected.replace('\r\n', '\n').splitlines(True))
+                with util.ReadFile(fname) as f:
+                    self.assertEqual(f.read(), expected)
+
+            # 'rU' translates every kind of line ending, as it does for an ordinary file
+            fname = os.path.join(tmpDir, 'mixed.gz')
+            mixed = 'a,1\rb,2\r\nc,3\n' * (util.streamBufferBytes // 7)
+            with open(fname, 'wb') as f:
+                f.write(_gzipped(mixed))
+            with util.openStream(fname) as f:
+                self.assertEqual(f.read(), mixed.replace('\r\n', '\n').replace('\r', '\n'))
+            with util.openStream(fname, 'rb') as f:
+                self.assertEqual(f.read(), mixed)
+
+            # highly compressible input is expanded a buffer at a time
+            fname = os.path.join(tmpDir, 'zeros.gz')
+            with open(fname, 'wb') as f:
+                f.write(_gzipped('\0' * (8 * util.streamBufferBytes)))
+            with util.openStream(fname, 'rb') as f:
+                reader = f.raw
+                total = 0
+                while True:
+                    chunk = f.read(util.streamBufferBytes)
+                    if not chunk:
+                        break
+                    total += len(chunk)
+                    self.assertTrue(len(reader._pending) <= util.streamBufferBytes)
+                self.assertEqual(total, 8 * util.streamBufferBytes)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_openstream_pipe(self):
+        # a pipe cannot be rewound after sniffing, so it is read as it is
+        data = 'a,b\r\n1,2\r\n'
+        r, w = os.pipe()
+        try:
+            os.write(w, data)
+            os.close(w)
+            w = None
+            fname = '/dev/fd/%d' % r
+            self.assertEqual(util.streamFormat(fname), None)
+            with util.openStream(fname) as f:
+                self.assertEqual(f.read(), 'a,b\n1,2\n')
+        finally:
+            os.close(r)
+            if w is not None:
+                os.close(w)
+
+    def test_mappedlines(self):
+        data = 'first\nsecond line\r\n\nlast, unterminated'
+        fd, fname = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            with util.MappedLines(fname) as lines:
+                self.assertEqual(lines.readline(), 'first\n')
+                self.assertEqual(list(lines), data.splitlines(True)[1:])
+                self.assertEqual(lines.readline(), '')
+            start = data.index('second')
+            with util.MappedLines(fname, start, start + 8) as lines:
+                self.assertEqual(list(lines), ['second l'])
+            with open(fname, 'wb'):
+                pass
+            with util.MappedLines(fname) as lines:
+                self.assertEqual(list(lines), [])
+        finally:
+            os.remove(fname)
+
+
+def _gzipped(data):
+    sio = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=sio, mode='wb') as f:
+        f.write(data)
+    return sio.getvalue()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+import os
+import sys
+import gzip
+import shutil
+import unittest
+import tempfile
+from collections import OrderedDict
+
+import phacsl.utils.formats.yaml_tools as yaml_tools
+
+
+SAMPLE_YAML = """---
+name: !!python/unicode 'Depot %d'
+abbrev: D%d
+category: depot
+zeta: {value: 3, prov: survey}
+alpha: [1, 2]
+"""
+
+
+class TestYamlTools(unittest.TestCase):
+
+    def setUp(self):
+        self.dirName = tempfile.mkdtemp()
+        for i in xrange(5):
+            with open(os.path.join(self.dirName, 'rec%d.yaml' % i), 'w') as f:
+                f.write(SAMPLE_YAML % (i, i))
+        with gzip.open(os.path.join(self.dirName, 'rec5.yaml.gz'), 'wb') as f:
+            f.write(SAMPLE_YAML % (5, 5))
+        with open(os.path.join(self.dirName, 'notes.txt'), 'w') as f:
+            f.write('not a record\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirName)
+
+    def test_parse_all(self):
+        allKeys, recs = yaml_tools.parse_all(self.dirName)
+        self.assertEqual(allKeys, set(['name', 'abbrev', 'category', 'zeta', 'alpha']))
+        self.assertEqual(sorted(rec['abbrev'] for rec in recs), ['D%d' % i for i in xrange(6)])
+        for rec in recs:
+            self.assertTrue(isinstance(rec, OrderedDict))
+            self.assertEqual(rec.keys(), ['name', 'abbrev', 'category', 'zeta', 'alpha'])
+            self.assertEqual(rec['name'], 'Depot %s' % rec['abbrev'][1:])
+        self.assertEqual(yaml_tools.parse_all(self.dirName, workers=2), (allKeys, recs))
+
+    def test_simplify(self):
+        rec = OrderedDict([('name', 'Depot 1'), ('name_prov', 'survey'),
+                           ('pop', {'value': {'raw': 1}, 'prov': 'census'}),
+                           ('staff', [{'category': 'Nurse', 'count': 3},
+                                      {'category': 'Clerk', 'value': 1},
+                                      {'category': 'Driver'}, 'Guard']),
+                           ('routes', [{'to': 'D2', 'to_prov': 'x'}, [1, 2]])])
+        self.assertEqual(yaml_tools._simplify(rec),
+                         {'name': 'Depot 1', 'pop': {'raw': 1}, 'staffNurse': 3,
+                          'staff': [1, 'Guard'], 'routes': [{'to': 'D2'}, [1, 2]]})
+        self.assertEqual(yaml_tools._simplify([1, {'value': 2}]), [1, 2])
+        self.assertEqual(yaml_tools._simplify('leaf'), 'leaf')
+
+        # nesting far deeper than the recursion limit
+        depth = 5 * sys.getrecursionlimit()
+        rec = {'leaf': 1, 'leaf_prov': 'x'}
+        for i in xrange(depth):
+            rec = {'level': i, 'child': [rec]}
+        simp = yaml_tools._simplify(rec)
+        for i in xrange(depth):
+            self.assertEqual(simp['level'], depth - 1 - i)
+            simp = simp['child'][0]
+        self.assertEqual(simp, {'leaf': 1})
+
+    def test_parse_all_simplified_cached(self):
+        expected = yaml_tools.parse_all_simplified(self.dirName)
+        self.assertEqual(yaml_tools.parse_all_simplified_cached(self.dirName), expected)
+        cachePath = os.path.join(self.dirName, '.simplified.cache')
+        self.assertTrue(os.path.exists(cachePath))
+
+        # an unchanged file is not read again
+        entries = yaml_tools._read_simplified_cache(cachePath)
+        entries['rec0.yaml'][2]['marker'] = True
+        yaml_tools._write_simplified_cache(cachePath, entries)
+        allKeys, recs = yaml_tools.parse_all_simplified_cached(self.dirName)
+        self.assertEqual([r.get('marker') for r in recs if r['abbrev'] == 'D0'], [True])
+
+        # changed, new and deleted files are noticed
+        with open(os.path.join(self.dirName, 'rec0.yaml'), 'a') as f:
+            f.write('extra: 1\n')
+        with open(os.path.join(self.dirName, 'rec9.yaml'), 'w') as f:
+            f.write(SAMPLE_YAML % (9, 9))
+        os.remove(os.path.join(self.dirName, 'rec1.yaml'))
+        expected = yaml_tools.parse_all_simplified(self.dirName)
+        self.assertEqual(yaml_tools.parse_all_simplified_cached(self.dirName), expected)
+        self.assertTrue('extra' in expected[0])
+        self.assertEqual(sorted(r['abbrev'] for r in expected[1]),
+                         ['D0', 'D2', 'D3', 'D4', 'D5', 'D9'])
+
+    def test_save_all(self):
+        allKeys, recs = yaml_tools.parse_all(self.dirName)
+        recs.sort(key=lambda rec: rec['abbrev'])
+        outDir = tempfile.mkdtemp()
+        try:
+            written = yaml_tools.save_all(outDir, recs)
+            self.assertEqual(sorted(written),
+                             [os.path.join(outDir, 'D%d.yaml' % i) for i in xrange(6)])
+            self.assertEqual(sorted(os.listdir(outDir)), ['D%d.yaml' % i for i in xrange(6)])
+            rec = yaml_tools.load_one(os.path.join(outDir, 'D2.yaml'))
+            self.assertEqual(rec.keys(), ['name', 'abbrev', 'category', 'alpha', 'zeta'])
+            self.assertEqual(dict(rec), dict(recs[2]))
+            umask = os.umask(0o022)
+            os.umask(umask)
+            self.assertEqual(os.stat(os.path.join(outDir, 'D2.yaml')).st_mode & 0o777,
+                             0o666 & ~umask)
+
+            # only the changed record is written again, keeping the file mode
+            os.chmod(os.path.join(outDir, 'D3.yaml'), 0o640)
+            recs[3]['alpha'].append(3)
+            self.assertEqual(yaml_tools.save_all(outDir, recs, workers=2),
+                             [os.path.join(outDir, 'D3.yaml')])
+            self.assertEqual(yaml_tools.load_one(os.path.join(outDir, 'D3.yaml'))['alpha'],
+                             [1, 2, 3])
+            self.assertEqual(os.stat(os.path.join(outDir, 'D3.yaml')).st_mode & 0o777, 0o640)
+            self.assertEqual(yaml_tools.save_all(outDir, recs), [])
+            # nor does the order of the keys matter
+            recs[3] = dict(reversed(recs[3].items()))
+            self.assertEqual(yaml_tools.save_all(outDir, recs), [])
+            self.assertEqual(len(os.listdir(outDir)), 6)
+
+            fileName = os.path.join(outDir, 'one.yaml')
+            rec = OrderedDict([('zeta', 1), ('alpha', 2), ('name', 'n')])
+            yaml_tools.save_one(fileName, rec, theseComeFirst=['name', 'abbrev'])
+            with open(fileName, 'rb') as f:
+                self.assertEqual(f.read(), '---\nname: n\nalpha: 2\nzeta: 1\n')
+            self.assertEqual(yaml_tools.load_one(fileName).keys()[0], 'name')
+        finally:
+            shutil.rmtree(outDir)
+
+
+if __name__ == "__main__":
+    unittest.main()